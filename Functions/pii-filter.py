@@ -1,41 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, TypedDict
 import json
 import logging
 import os
+import stat
 import sys
 import threading
 
 
+try:
+    # Use the faster orjson library for JSON decoding on the request path, if available
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+
+# Stream handler for logging, built once and shared by all instances of the filter
+_LOG_HANDLER = logging.StreamHandler(stream=sys.stdout)
+_LOG_HANDLER.setFormatter(logging.Formatter(
+    fmt='%(asctime)s + %(levelname)-8s + %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+))
+
+# Background workers removing user-uploaded files, keeping file deletion out of the request path
+_UNLINK_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="unlink")
+
+# Number of locks guarding the shared dictionaries, so that unrelated user-chat keys do not contend
+_LOCK_STRIPES = 16
+
+# Constant sections of the outlet response, built once instead of on every response
+_PII_TABLE_HEADER = (
+    "\n\n---\n"
+    "| Document | Original text | Category | Type | Justification |\n"
+    "|:---------|:--------------|:-----|:--------|:-------|\n"
+)
+_OTHER_FILES_NOTICE = (
+    "\n\n---\nThe following uploaded files could not be processed"
+    " because this model only supports DOCX files with UTF-8 encoding:\n\n"
+)
+
+# Content types of the user-uploaded files which can be processed (DOCX documents)
+_ACCEPTABLE_CONTENT_TYPES = frozenset({
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+})
+
+# Entry returned for user-chat combinations without uploaded files (shared, must never be mutated)
+_EMPTY_USER_FILES: 'UserFiles' = {'acceptable': {}, 'other': {}}
+
+
+class _LazyJson:
+    '''
+    This is a class for deferring the JSON serialization
+    of an object until it is formatted by the logging
+    module, so that no serialization takes place for log
+    records which are not emitted.
+    '''
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        # Objects which are not JSON serializable are exported through their to_dict method
+        return json.dumps(self.obj, indent=2, default=lambda o: o.to_dict())
+
+
+class UserFile:
+    '''
+    This is a class for representing a record of a
+    user-uploaded file. It stores the file ID, the file
+    name, the file path in storage and the identified
+    PIIs of the file. It uses slots instead of a per-record
+    dictionary to reduce the memory footprint of each entry.
+    '''
+    __slots__ = ('id', 'filename', 'filepath', 'pii')
+
+    def __init__(self, id: str, filename: str, filepath: str):
+        self.id = id
+        self.filename = filename
+        self.filepath = filepath
+        self.pii = None
+
+    def __repr__(self) -> str:
+        return f"UserFile(id={self.id}, filename={self.filename})"
+
+    def to_dict(self) -> dict:
+        """Convert UserFile instance to a dictionary."""
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "filepath": self.filepath,
+            "pii": self.pii,
+        }
+
+
+class UserFiles(TypedDict):
+    '''
+    This is a class for annotating the per-request container
+    of user-uploaded file records, split into acceptable
+    (DOCX) files and other files. It is a plain dictionary
+    at runtime, so it adds no validation overhead.
+    '''
+    acceptable: dict[str, UserFile]
+    other: dict[str, UserFile]
+
+
 class SharedUserFilesLatestUploadDict:
     '''
     This is a class for creating a shared dictionary
     for storing the latest file upload of the users'
-    files. It uses a lock to ensure thread safety when
-    accessing the shared dictionary.
+    files. It uses striped locks, selected by key, to ensure
+    thread safety when modifying the shared dictionary,
+    while single-lookup reads are lock-free.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]  # Create a set of striped locks
 
-    def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
-        return_data = 0
+    def _lock_for(self, key: tuple[str, str]) -> threading.Lock:
+        # Select the lock guarding the stripe of the key
+        return self._locks[hash(key) % _LOCK_STRIPES]
 
+    def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
         # Construct the key for the user_id and chat_id
-        key = f'{user_id}_{chat_id}'
-
-        with self._lock:  # Acquire the lock for retrieving data
-            # Check if the key exists in the dictionary
-            if key in self._data:
-                return_data = self._data[key]
+        key = (user_id, chat_id)
 
-        return return_data
+        # A single dictionary lookup is atomic, hence no lock is required for reading
+        return self._data.get(key, 0)
 
     def update_user_latest_timestamp(self, user_id: str, chat_id: str, timestamp: int) -> None:
         # Construct the key for the user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = (user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for inserting data
+        with self._lock_for(key):  # Acquire the lock for inserting data
             # Check if the key exists in the dictionary
             if key not in self._data:
                 # User ID does not exist in the dictionary - create an entry for it
@@ -49,94 +149,84 @@ class SharedUserFilesDict:
     '''
     This is a class for creating a shared dictionary
     for storing information on the latest user-uploaded
-    files. It uses a lock to ensure thread safety when
-    accessing the shared dictionary.
+    files. It uses striped locks, selected by key, to ensure
+    thread safety when modifying the shared dictionary,
+    while single-lookup reads are lock-free.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]  # Create a set of striped locks
 
-    def get_acceptable_user_files(self, user_id: str, chat_id: str) -> dict:
-        return_data = {}
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for retrieving data
-            if key in self._data:
-                # Return user-uploaded acceptable files
-                return_data = self._data[key]['acceptable']
-        return return_data
-
-    def get_other_user_files(self, user_id: str, chat_id: str) -> dict:
-        return_data = {}
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for retrieving data
-            if key in self._data:
-                # Return user-uploaded "other" files
-                return_data = self._data[key]['other']
-        return return_data
-
-    def get_user_files(self, user_id: str, chat_id: str) -> dict:
-        return_data = {}
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for retrieving data
-            if key in self._data:
-                # Return all user-uploaded files
-                return_data = self._data[key]
-        return return_data
+    def _lock_for(self, key: tuple[str, str]) -> threading.Lock:
+        # Select the lock guarding the stripe of the key
+        return self._locks[hash(key) % _LOCK_STRIPES]
+
+    def get_acceptable_user_files(self, user_id: str, chat_id: str) -> dict[str, UserFile]:
+        key = (user_id, chat_id)
+        # Return user-uploaded acceptable files (a single dictionary lookup is atomic, no lock required)
+        return self._data.get(key, _EMPTY_USER_FILES)['acceptable']
+
+    def get_other_user_files(self, user_id: str, chat_id: str) -> dict[str, UserFile]:
+        key = (user_id, chat_id)
+        # Return user-uploaded "other" files (a single dictionary lookup is atomic, no lock required)
+        return self._data.get(key, _EMPTY_USER_FILES)['other']
+
+    def get_user_files(self, user_id: str, chat_id: str) -> UserFiles:
+        key = (user_id, chat_id)
+        # Return all user-uploaded files (a single dictionary lookup is atomic, no lock required)
+        return self._data.get(key, _EMPTY_USER_FILES)
 
     def insert_acceptable_user_files(self, user_id: str, chat_id: str, files: dict) -> None:
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for inserting data
-            if key not in self._data:
-                # User ID does not exist in the dictionary - create an entry for it
-                self._data[key] = {'acceptable': {}, 'other': {}}
-            # Insert new user-uploaded acceptable files in the dictionary
-            self._data[key]['acceptable'].update(files)
+        key = (user_id, chat_id)
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            # Create an entry for the key if it does not exist and insert new user-uploaded acceptable files in it
+            self._data.setdefault(key, {'acceptable': {}, 'other': {}})['acceptable'].update(files)
 
     def insert_other_user_files(self, user_id: str, chat_id: str, files: dict) -> None:
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for inserting data
-            if key not in self._data:
-                # User ID does not exist in the dictionary - create an entry for it
-                self._data[key] = {'acceptable': {}, 'other': {}}
-            # Insert new user-uploaded "other" files in the dictionary
-            self._data[key]['other'].update(files)
-
-    def insert_user_files(self, user_id: str, chat_id: str, files: dict) -> None:
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for inserting data
-            if key not in self._data:
-                # user_id exists in the dictionary - insert user_id into the dictionary
-                self._data[key] = {'acceptable': {}, 'other': {}}
-            # Insert new user-uploaded acceptable and "other" files in the dictionary
-            self._data[key]['acceptable'].update(files['acceptable'])
-            self._data[key]['other'].update(files['other'])
+        key = (user_id, chat_id)
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            # Create an entry for the key if it does not exist and insert new user-uploaded "other" files in it
+            self._data.setdefault(key, {'acceptable': {}, 'other': {}})['other'].update(files)
+
+    def insert_user_files(self, user_id: str, chat_id: str, files: UserFiles) -> None:
+        key = (user_id, chat_id)
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            # Adopt the caller's dictionary as the entry for the key if it does not exist, without allocating a new one
+            entry = self._data.setdefault(key, files)
+            if entry is not files:
+                # Insert new user-uploaded acceptable and "other" files in the existing entry
+                entry['acceptable'].update(files['acceptable'])
+                entry['other'].update(files['other'])
 
     def delete_acceptable_user_files(self, user_id: str, chat_id: str) -> None:
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for writing
+        key = (user_id, chat_id)
+        with self._lock_for(key):  # Acquire the lock for writing
             if key in self._data:
                 # Remove user-uploaded acceptable files from the dictionary
                 del self._data[key]['acceptable']
 
     def delete_other_user_files(self, user_id: str, chat_id: str) -> None:
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for writing
+        key = (user_id, chat_id)
+        with self._lock_for(key):  # Acquire the lock for writing
             if key in self._data:
                 # Remove user-uploaded "other" files from the dictionary
                 del self._data[key]['other']
 
     def delete_user_files(self, user_id: str, chat_id: str) -> None:
-        key = f'{user_id}_{chat_id}'
-        with self._lock:  # Acquire the lock for writing
-            if key in self._data:
-                # Remove all user-related entries from the dictionary
-                del self._data[key]['acceptable']
-                del self._data[key]['other']
-                del self._data[key]
+        key = (user_id, chat_id)
+        with self._lock_for(key):  # Acquire the lock for writing
+            # Remove the user-related entry from the dictionary, leaving the (possibly adopted) file container intact
+            self._data.pop(key, None)
 
     def get_all_data(self) -> dict:
-        with self._lock:  # Acquire the lock for writing
+        # Acquire all locks (always in the same order) for a consistent snapshot
+        for lock in self._locks:
+            lock.acquire()
+        try:
             return dict(self._data)
+        finally:
+            for lock in self._locks:
+                lock.release()
 
 
 class Filter:
@@ -155,21 +245,19 @@ class Filter:
 
     def __init__(self):
         '''Constructor method'''
-        # Initialize OpenAI API information from environment variables through valves.
-        self.valves = self.Valves()
+        # Reuse the valves built once at module import, instead of validating them on every construction
+        self.valves = _VALVES
 
         # Enable logging and set level to DEBUG
         logger = logging.getLogger(self.valves.APP_ID)
         logger.setLevel(logging.DEBUG)
 
-        # Set logging parameters
-        formatter = logging.Formatter(
-            fmt='%(asctime)s + %(levelname)-8s + %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        handlersys = logging.StreamHandler(stream=sys.stdout)
-        handlersys.setFormatter(formatter)
-        logger.addHandler(handlersys)
+        # Attach the shared stream handler only once, so that repeated constructions do not duplicate log records
+        if _LOG_HANDLER not in logger.handlers:
+            logger.addHandler(_LOG_HANDLER)
+
+        # Keep a reference to the logger to avoid looking it up on every call
+        self.logger = logger
 
         # Initialize the path to the default Open WebUI file upload directory
         self.default_file_upload_path = "/app/backend/data/uploads"
@@ -186,7 +274,7 @@ class Filter:
 
     async def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies form data and user input before forwarding the request to the model.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("INLET begin:\nBody:\n%s", _LazyJson(body))
 
         # Extract user chat, session and files information from the request body
         body_files = body.get("files", [])
@@ -214,44 +302,52 @@ class Filter:
             new_latest_timestamp = latest_timestamp
 
 
-            user_files = {'acceptable': {}, 'other': {}}
+            user_files: UserFiles = {'acceptable': {}, 'other': {}}
+
+            # Bind the names used on every loop iteration to local variables, avoiding repeated global and attribute lookups
+            path_join = os.path.join
+            os_stat = os.stat
+            is_regular_file = stat.S_ISREG
+            upload_path = self.default_file_upload_path
+            acceptable_files = user_files['acceptable']
+            other_files = user_files['other']
+            acceptable_content_types = _ACCEPTABLE_CONTENT_TYPES
 
             try:
                 # Iterate over the whole list of uploaded files
                 for file_info in body_files:
                     # Extract file information
                     file = file_info["file"]
+                    file_id = file["id"]
 
                     # Construct input file path in storage
-                    file_path = os.path.join(
-                        self.default_file_upload_path, f'{file["id"]}_{file["filename"]}'
-                    )
+                    file_path = path_join(upload_path, f'{file_id}_{file["filename"]}')
+
+                    try:
+                        # Retrieve the file status with a single system call
+                        file_stat = os_stat(file_path)
+                    except OSError:
+                        # File does not exist in the file system or cannot be accessed
+                        continue
 
-                    # Check if file exists in the file system
-                    if os.path.exists(file_path) and os.path.isfile(file_path):
+                    # Check if file is a regular file
+                    if is_regular_file(file_stat.st_mode):
                         # Check if input file type is an acceptable document
-                        if file['meta']['content_type'] == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+                        if file['meta']['content_type'] in acceptable_content_types:
                             # Add file ID to the list of collected file IDs
-                            user_files['acceptable'][file["id"]] = {
-                                "id": file["id"],
-                                "filename": file["filename"],
-                                "filepath": file_path,
-                            }
+                            acceptable_files[file_id] = UserFile(file_id, file["filename"], file_path)
                         else:
                             # Add file ID to the list of collected file IDs
-                            user_files['other'][file["id"]] = {
-                                "id": file["id"],
-                                "filename": file["filename"],
-                                "filepath": file_path,
-                            }
+                            other_files[file_id] = UserFile(file_id, file["filename"], file_path)
 
-                        if int(file["created_at"]) > new_latest_timestamp:
+                        created_at = int(file["created_at"])
+                        if created_at > new_latest_timestamp:
                             # Update the latest timestamp of the uploaded files
-                            new_latest_timestamp = int(file["created_at"])
+                            new_latest_timestamp = created_at
 
-                logging.getLogger(self.valves.APP_ID).debug(f"INLET: User-uploaded files '{json.dumps(user_files, indent=2)}'")
+                self.logger.debug("INLET: User-uploaded files '%s'", _LazyJson(user_files))
             except Exception as e:
-                logging.getLogger(self.valves.APP_ID).error(f"INLET: Exception while processing user-uploaded files: {e}")
+                self.logger.error(f"INLET: Exception while processing user-uploaded files: {e}")
 
             # Update the latest timestamp of the user in the shared dictionary
             self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, new_latest_timestamp)
@@ -259,23 +355,26 @@ class Filter:
             # Insert new user-uploaded files into the shared dictionary
             self.user_uploaded_files.insert_user_files(user_id, chat_id, user_files)
 
-            logging.getLogger(self.valves.APP_ID).debug(f"INLET: User-uploaded files:\n{json.dumps(user_files, indent=2)}")
+            self.logger.debug("INLET: User-uploaded files:\n%s", _LazyJson(user_files))
 
             # Keep only new and acceptable files in the request body (removing previously processed and unacceptable files)
-            body["files"] = [file_info for file_info in body["files"] if file_info["file"]["id"] in user_files['acceptable'].keys()]
-            body["metadata"]["files"] = [file_info for file_info in body["metadata"]["files"] if file_info["file"]["id"] in user_files['acceptable'].keys()]
+            body["files"] = [file_info for file_info in body["files"] if file_info["file"]["id"] in acceptable_files]
+            body["metadata"]["files"] = [file_info for file_info in body["metadata"]["files"] if file_info["file"]["id"] in acceptable_files]
 
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET end")
+        self.logger.debug(f"INLET end")
 
         return body
 
     async def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies model response form data before returning them to the user.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("OUTLET begin:\nBody:\n%s", _LazyJson(body))
 
         # Initialize an empty string for the prompt response
         prompt_response = ""
 
+        # Collect the parts of the prompt response, to be joined once at the end
+        parts = []
+
         # Extract user chat information
         chat_id = body.get('chat_id', '')
 
@@ -283,121 +382,141 @@ class Filter:
         user_id = __user__['id']
 
         # Retrieve user-uploaded files from the shared dictionary
-        user_files = self.user_uploaded_files.get_user_files(user_id, chat_id)
+        user_files: UserFiles = self.user_uploaded_files.get_user_files(user_id, chat_id)
 
         # Get content from model response
         model_response_content = body.get('messages', [])[-1].get('content', '')
 
         try:
             # Get response content (substitutions) as a JSON object
-            piis = json.loads(model_response_content)
+            piis = _json_loads(model_response_content)
 
-            logging.getLogger(self.valves.APP_ID).debug(f"OUTLET: Received files PIIs:\n{json.dumps(piis, indent=2)}")
+            self.logger.debug("OUTLET: Received files PIIs:\n%s", _LazyJson(piis))
 
             # Check if text in any user-uploaded acceptable files was processed
             if piis:
-                # Create a list for collecting file IDs of the acceptable files which where successfully processed
-                processed_file_ids = []
-
                 # Iterate over the list of modified files
                 for entry in piis:
                     if entry['pii']:
-                        user_files['acceptable'][entry['id']]['pii'] = entry['pii']
+                        user_files['acceptable'][entry['id']].pii = entry['pii']
 
-                        # Collect file ID
-                        processed_file_ids.append(entry['id'])
+                # Partition the acceptable files into successfully processed and failed ones in a single pass
+                processed_files, unprocessed_files = [], []
+                for v in user_files['acceptable'].values():
+                    (processed_files if v.pii else unprocessed_files).append(v)
 
-                if processed_file_ids:
-                    prompt_response = prompt_response + \
-                        "All sensitive information in the following DOCX files has been processed successfully:\n\n" + \
-                        "\n".join([f"- **{v['filename']}**" for k, v in user_files['acceptable'].items() if k in processed_file_ids])
+                if processed_files:
+                    parts.append("All sensitive information in the following DOCX files has been processed successfully:\n\n")
+                    parts.append("\n".join(f"- **{v.filename}**" for v in processed_files))
 
-                    prompt_response = prompt_response + "\n\n---\n" + \
-                        "| Document | Original text | Category | Type | Justification |\n" + \
-                        "|:---------|:--------------|:-----|:--------|:-------|\n"
+                    parts.append(_PII_TABLE_HEADER)
 
                     for entry in piis:
-                        filename = user_files['acceptable'][entry['id']]['filename']
+                        filename = user_files['acceptable'][entry['id']].filename
                         for pii in entry['pii']:
-                            prompt_response = prompt_response + \
-                                f"| {filename} | {pii['text']} | {pii['category']} | {pii['type']} | {pii['justification']} |\n"
+                            parts.append(f"| {filename} | {pii['text']} | {pii['category']} | {pii['type']} | {pii['justification']} |\n")
 
-                    # Collect file IDs of acceptable files whose processing failed
-                    unprocessed_file_ids = set(user_files['acceptable'].keys()).difference(set(processed_file_ids))
-
-                    if unprocessed_file_ids:
+                    if unprocessed_files:
                         # Add additional message output for failed files
-                        if prompt_response:
-                            prompt_response = prompt_response + "\n\n---\n"
+                        if parts:
+                            parts.append("\n\n---\n")
 
-                        prompt_response = prompt_response + \
-                            "\n\nThe following DOCX files could not be processed due to some system error:\n\n" + \
-                            "\n".join([f"- **{v['filename']}**" for k, v in user_files['acceptable'].items() if k in unprocessed_file_ids])
+                        parts.append("\n\nThe following DOCX files could not be processed due to some system error:\n\n")
+                        parts.append("\n".join(f"- **{v.filename}**" for v in unprocessed_files))
                 else:
-                    prompt_response = "The uploaded DOCX files could not be processed due to some system error."
+                    parts.append("The uploaded DOCX files could not be processed due to some system error.")
             else:
-                prompt_response = "No PIIs were detected."
+                parts.append("No PIIs were detected.")
 
             if user_files['other']:
                 # Add additional message output for non-acceptable files
-                prompt_response = prompt_response + \
-                    "\n\n---\nThe following uploaded files could not be processed" + \
-                    " because this model only supports DOCX files with UTF-8 encoding:\n\n"
-                prompt_response = prompt_response + \
-                    "\n".join([f"* **{v['filename']}**" for v in user_files['other'].values()])
+                parts.append(_OTHER_FILES_NOTICE)
+                parts.append("\n".join(f"* **{v.filename}**" for v in user_files['other'].values()))
+
+            # Join the collected parts into the prompt response in a single pass
+            prompt_response = ''.join(parts)
         except SyntaxError as e:
-            logging.getLogger(self.valves.APP_ID).error(f"OUTLET: Response to the HTTP request sent to the pipeline is not a valid syntax object: {e}")
+            self.logger.error(f"OUTLET: Response to the HTTP request sent to the pipeline is not a valid syntax object: {e}")
             prompt_response = "A server error occurred while processing the uploaded DOCX files."
         except TypeError as e:
-            logging.getLogger(self.valves.APP_ID).error(f"OUTLET: Response to the HTTP request sent to the pipeline is of wrong type: {e}")
+            self.logger.error(f"OUTLET: Response to the HTTP request sent to the pipeline is of wrong type: {e}")
             prompt_response = "A server error occurred while processing the uploaded DOCX files."
         except json.JSONDecodeError as e:
-            logging.getLogger(self.valves.APP_ID).error(f"OUTLET: Response to the HTTP request sent to the pipeline is not a valid JSON object: {e}")
-            logging.getLogger(self.valves.APP_ID).error(f"OUTLET: Erroneous pipeline response: {prompt_response}")
+            self.logger.error(f"OUTLET: Response to the HTTP request sent to the pipeline is not a valid JSON object: {e}")
+            self.logger.error(f"OUTLET: Erroneous pipeline response: {prompt_response}")
             if model_response_content == None:
                 prompt_response = "A server error occurred while processing the uploaded DOCX files."
             else:
                 prompt_response = model_response_content
         except Exception as e: # Catch all other exceptions.
-            logging.getLogger(self.valves.APP_ID).error(f"OUTLET: An unexpected error occurred while processing files: {e}")
+            self.logger.error(f"OUTLET: An unexpected error occurred while processing files: {e}")
             prompt_response = "A server error occurred while processing the uploaded DOCX files - some files failed to be processed."
 
         if prompt_response:
             # Update the last chat message (what the user will percieve as the model response) with the formatted response
             body['messages'][-1]['content'] = prompt_response
 
-        # Delete user-uploaded acceptable files from the file system
-        self._fs_delete_files([v['filepath'] for v in user_files['acceptable'].values()])
-
-        # Delete user-uploaded 'other' files from the file system
-        self._fs_delete_files([v['filepath'] for v in user_files['other'].values()])
+        # Delete user-uploaded acceptable and 'other' files from the file system in a single background batch
+        _UNLINK_POOL.submit(
+            self._fs_delete_files,
+            [f"{v.id}_{v.filename}" for v in user_files['acceptable'].values()] +
+            [f"{v.id}_{v.filename}" for v in user_files['other'].values()]
+        )
 
         # Remove user-uploaded files from the shared dictionary (if any)
         self.user_uploaded_files.delete_user_files(user_id, chat_id)
 
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET end")
+        self.logger.debug(f"OUTLET end")
 
         return body
 
-    def _fs_delete_files(self, file_paths: list[str]) -> None:
+    def _fs_delete_files(self, file_names: list[str]) -> None:
         '''
-        Delete files from file system
+        Delete files from the Open WebUI file upload directory
+
+        The upload directory is opened once and every file is unlinked
+        relative to it, so that the kernel does not resolve the full
+        path of the upload directory for each deleted file.
+
+        This function runs in a background worker, hence all errors are
+        logged and none are propagated to the caller.
 
         Input parameters:
-        * file_paths: A list with the file paths to be deleted.
+        * file_names: A list with the names of the files to be deleted.
         '''
-        for path in file_paths:
-            if path:
-                try:
-                    if os.path.exists(path) and os.path.isfile(path):
-                        os.remove(path)
-                except TypeError as e:
-                    logging.getLogger(self.valves.APP_ID).error(f"_fs_delete_files: File '{path}' is invalid: {e}")
-                except FileNotFoundError as e:
-                    logging.getLogger(self.valves.APP_ID).error(f"_fs_delete_files: File '{path}' not found: {e}")
-                except UnicodeEncodeError as e:
-                    logging.getLogger(self.valves.APP_ID).error(f"_fs_delete_files: File '{path}' contains invalid characters: {e}")
-                except PermissionError as e:
-                    logging.getLogger(self.valves.APP_ID).error(f"_fs_delete_files: Permission denied to delete '{path}': {e}")
-                except OSError as e:
-                    logging.getLogger(self.valves.APP_ID).error(f"_fs_delete_files: An unexpected error occurred while trying to delete '{path}': {e}")
\ No newline at end of file
+        if not any(file_names):
+            return
+
+        try:
+            # Open the upload directory once for the whole batch of files
+            dir_fd = os.open(self.default_file_upload_path, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            self.logger.error(f"_fs_delete_files: Could not open upload directory '{self.default_file_upload_path}': {e}")
+            return
+
+        try:
+            for name in file_names:
+                if name:
+                    try:
+                        # Unlink the file directly, letting the system call report missing files and directories
+                        os.unlink(name, dir_fd=dir_fd)
+                    except TypeError as e:
+                        self.logger.error(f"_fs_delete_files: File '{name}' is invalid: {e}")
+                    except FileNotFoundError as e:
+                        self.logger.error(f"_fs_delete_files: File '{name}' not found: {e}")
+                    except UnicodeEncodeError as e:
+                        self.logger.error(f"_fs_delete_files: File '{name}' contains invalid characters: {e}")
+                    except IsADirectoryError as e:
+                        self.logger.error(f"_fs_delete_files: '{name}' is a directory, not a file: {e}")
+                    except PermissionError as e:
+                        self.logger.error(f"_fs_delete_files: Permission denied to delete '{name}': {e}")
+                    except OSError as e:
+                        self.logger.error(f"_fs_delete_files: An unexpected error occurred while trying to delete '{name}': {e}")
+                    except Exception as e: # Catch all other exceptions, as there is no caller to propagate them to.
+                        self.logger.error(f"_fs_delete_files: Failed to delete '{name}': {e}")
+        finally:
+            os.close(dir_fd)
+
+
+# Build the valves once from their environment variable defaults, skipping pydantic validation
+_VALVES = Filter.Valves.model_construct()
\ No newline at end of file
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, Field
 from typing import Optional
 import errno
@@ -7,6 +8,30 @@ import os
 import sys
 
 
+try:
+    # Use the faster orjson library for JSON encoding and decoding on the request path, if available
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+
+# Stream handler for logging, built once and shared by all instances of the filter
+_LOG_HANDLER = logging.StreamHandler(stream=sys.stdout)
+_LOG_HANDLER.setFormatter(logging.Formatter(
+    fmt='%(asctime)s + %(levelname)-8s + %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+))
+
+# Background workers removing user-uploaded files, keeping file deletion out of the request path
+_UNLINK_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="unlink")
+
+
 class Filter:
     '''
     This is a class for creating a Filter function for assisting
@@ -26,21 +51,19 @@ class Filter:
 
     def __init__(self):
         ''' Constructor method '''
-        # Initialize OpenAI API information from environment variables through valves.
-        self.valves = self.Valves()
+        # Reuse the valves built once at module import, instead of validating them on every construction
+        self.valves = _VALVES
 
         # Enable logging and set level to DEBUG
         logger = logging.getLogger(self.valves.APP_ID)
         logger.setLevel(logging.DEBUG)
 
-        # Set logging parameters
-        formatter = logging.Formatter(
-            fmt='%(asctime)s + %(levelname)-8s + %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        handlersys = logging.StreamHandler(stream=sys.stdout)
-        handlersys.setFormatter(formatter)
-        logger.addHandler(handlersys)
+        # Attach the shared stream handler only once, so that repeated constructions do not duplicate log records
+        if _LOG_HANDLER not in logger.handlers:
+            logger.addHandler(_LOG_HANDLER)
+
+        # Keep a reference to the logger to avoid looking it up on every call
+        self.logger = logger
 
         # Initialize the default Open WebUI file upload directory
         self.default_file_upload_path = "/app/backend/data/uploads"
@@ -51,67 +74,87 @@ class Filter:
 
     async def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies form data and user input before forwarding the request to the model.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"INLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug(f"INLET begin")
+        # self.logger.debug(f"INLET begin:\nBody:\n{json.dumps(body, indent=2)}")
 
         # Insert desired file information into the request body
-        body["messages"][-1]['content'] = json.dumps({
+        body["messages"][-1]['content'] = _json_dumps({
             'user_message': body["messages"][-1]['content'],
             'chat_id': body.get('metadata', {}).get('chat_id', ''),
         })
 
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET end")
+        self.logger.debug(f"INLET end")
 
         return body
 
     async def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies model response form data before returning them to the user.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug(f"OUTLET begin")
+        # self.logger.debug(f"OUTLET begin:\nBody:\n{json.dumps(body, indent=2)}")
 
         # If the model response contains an error message, log it
         if 'ERROR: ' in body.get('messages', [])[-1]['content']:
-            logging.getLogger(self.valves.APP_ID).error(f"OUTLET: Model response contains an error: {body.get('messages', [])[-1]['content']}")
+            self.logger.error(f"OUTLET: Model response contains an error: {body.get('messages', [])[-1]['content']}")
         else:
-            # logging.getLogger(self.valves.APP_ID).debug(f"OUTLET: Model response content: {body.get('messages', [])[-1]['content']}")
+            # self.logger.debug(f"OUTLET: Model response content: {body.get('messages', [])[-1]['content']}")
 
-            result = json.loads(body.get('messages', [])[-1]['content'])
+            result = _json_loads(body.get('messages', [])[-1]['content'])
 
-            content = ''
+            # Collect the summary section of each file, to be joined once at the end
+            parts = []
 
             for file_info in result:
                 if file_info.get('id', '') and file_info.get('filename', '') and file_info.get('summary', ''):
-                    content += f'### Summary for file **{file_info["filename"].strip()}**:\n{file_info["summary"].strip()}\n\n---\n'
+                    parts.append(f'### Summary for file **{file_info["filename"].strip()}**:\n{file_info["summary"].strip()}')
 
-            if content:
-                content = content[:-4].strip()
-                body['messages'][-1]['content'] = content
+            if parts:
+                body['messages'][-1]['content'] = '\n\n---\n'.join(parts)
 
-            self._fs_delete_files([os.path.join(self.default_file_upload_path, f"{file_info['id']}_{file_info['filename']}") for file_info in result])
+            # Delete user-uploaded files from the file system in the background
+            _UNLINK_POOL.submit(self._fs_delete_files, [f"{file_info['id']}_{file_info['filename']}" for file_info in result])
 
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET end")
+        self.logger.debug(f"OUTLET end")
 
         return body
 
-    def _fs_delete_files(self, file_paths: list[str]) -> None:
+    def _fs_delete_files(self, file_names: list[str]) -> None:
         '''
-        Delete files from file system
+        Delete files from the Open WebUI file upload directory,
+        unlinking each file relative to a single directory handle.
+        Runs in a background worker, so errors are only logged.
 
         Input parameters:
-        * file_paths: A list with the file paths to be deleted.
+        * file_names: A list with the names of the files to be deleted.
         '''
-        for path in file_paths:
-            try:
-                # Remove other user-uploaded files
-                os.remove(path)
-            except FileNotFoundError:
-                logging.getLogger(self.valves.APP_ID).error(f'''_fs_delete_files: File '{path}' not found.''')
-            except PermissionError:
-                logging.getLogger(self.valves.APP_ID).error(f'''_fs_delete_files: Permission denied to delete '{path}'.''')
-                raise
-            except OSError as e:
-                if e.errno == errno.EISDIR:
-                    logging.getLogger(self.valves.APP_ID).error(f'''_fs_delete_files: '{path}' is a directory, not a file.''')
-                else:
-                    logging.getLogger(self.valves.APP_ID).error(f'''_fs_delete_files: An unexpected error occurred while trying to delete '{path}': {e}''')
-                    raise
\ No newline at end of file
+        if not file_names:
+            return
+
+        try:
+            # Open the upload directory once for the whole batch of files
+            dir_fd = os.open(self.default_file_upload_path, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            self.logger.error(f'''_fs_delete_files: Could not open upload directory '{self.default_file_upload_path}': {e}''')
+            return
+
+        try:
+            for name in file_names:
+                try:
+                    # Remove other user-uploaded files
+                    os.unlink(name, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    self.logger.error(f'''_fs_delete_files: File '{name}' not found.''')
+                except PermissionError:
+                    self.logger.error(f'''_fs_delete_files: Permission denied to delete '{name}'.''')
+                except OSError as e:
+                    if e.errno == errno.EISDIR:
+                        self.logger.error(f'''_fs_delete_files: '{name}' is a directory, not a file.''')
+                    else:
+                        self.logger.error(f'''_fs_delete_files: An unexpected error occurred while trying to delete '{name}': {e}''')
+                except Exception as e: # Catch all other exceptions, as there is no caller to propagate them to.
+                    self.logger.error(f'''_fs_delete_files: Failed to delete '{name}': {e}''')
+        finally:
+            os.close(dir_fd)
+
+
+# Build the valves once from their environment variable defaults, skipping pydantic validation
+_VALVES = Filter.Valves.model_construct()
\ No newline at end of file
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langgraph_sdk import get_sync_client
 from pydantic import BaseModel, Field
 from typing import Generator, Iterator, Optional, Union
@@ -6,99 +7,154 @@ import logging
 import os
 import sys
 import threading
-import uuid
+import time
+
+
+# Number of locks guarding the shared dictionaries, so that unrelated user-chat keys do not contend
+_LOCK_STRIPES = 16
+
+# Time (in seconds) after its last write for which an entry is kept in the shared dictionaries,
+# so that entries of abandoned chats do not accumulate, and interval (in seconds) between prunings
+_ENTRY_TTL = 24 * 60 * 60
+_PRUNE_INTERVAL = 10 * 60
+
+# Marker and terminator wrapping the chat ID appended to the last user message, as
+# Open WebUI does not forward the request metadata (and thus the chat ID) to the Pipe method
+_CHAT_ID_MARKER = "\n\n\n\n\nChat ID\n\n\n\n\n"
+_CHAT_ID_TERMINATOR = "\n\n\n\n\n"
+
+
+class _LazyJson:
+    '''
+    This is a class for deferring the JSON serialization
+    of an object until it is formatted by the logging
+    module, so that no serialization takes place for log
+    records which are not emitted.
+    '''
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj, indent=2)
 
 
 class SharedUserFilesDict:
     '''
     This is a class for creating a shared dictionary
     for storing information on the latest user-uploaded
-    files. It uses a lock to ensure thread safety when
-    accessing the shared dictionary.
+    files. It uses striped locks, selected by key, to ensure
+    thread safety when modifying the shared dictionary,
+    while single-lookup reads are lock-free. Entries which
+    are not written for a day are pruned lazily on writes.
     '''
     def __init__(self):
-        self._data = dict()  # Dictionary to store user files
-        self._lock = threading.Lock()  # Create a lock
+        self._data = dict()  # Dictionary to store user files, indexed by file ID
+        self._touched = dict()  # Dictionary to store the time of the latest write of each entry
+        self._next_prune = time.monotonic() + _PRUNE_INTERVAL
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]  # Create a set of striped locks
+
+    def _lock_for(self, key: tuple[str, str]) -> threading.Lock:
+        # Select the lock guarding the stripe of the key
+        return self._locks[hash(key) % _LOCK_STRIPES]
+
+    def _prune(self) -> None:
+        # Remove entries which have not been written for longer than their time-to-live, at most once per interval
+        now = time.monotonic()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + _PRUNE_INTERVAL
+
+        cutoff = now - _ENTRY_TTL
+        for key, touched in list(self._touched.items()):
+            if touched < cutoff:
+                with self._lock_for(key):  # Acquire the lock for writing
+                    # Check again under the lock, as the entry may have been written in the meantime
+                    if self._touched.get(key, now) < cutoff:
+                        self._data.pop(key, None)
+                        self._touched.pop(key, None)
 
     def get_user_files(self, user_id: str, chat_id: str) -> list:
-        return_data = []
-
         # Construct the key for the user_id and chat_id
-        key = f'{user_id}_{chat_id}'
-
-        with self._lock:  # Acquire the lock for retrieving data
-            # Check if the key exists in the dictionary
-            if key in self._data:
-                return_data = self._data[key]
+        key = (user_id, chat_id)
 
-        return return_data
+        # A single dictionary lookup is atomic, hence no lock is required for reading
+        # Return a new list of the files, so that callers never share the internal container
+        return list(self._data.get(key, {}).values())
 
     def insert_user_files(self, user_id: str, chat_id: str, files: list) -> None:
         # Construct the key for the user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = (user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for inserting data
-            # Check if the key exists in the dictionary
-            if key not in self._data:
-                # User ID does not exist in the dictionary - create an entry for it
-                self._data[key] = files
-            else:
-                # Update the existing user files with the new ones
-                existing_files = self._data[key]
-                # Merge new files with existing ones, avoiding duplicates
-                for file in files:
-                    if file not in existing_files:
-                        existing_files.append(file)
+        # Index the new files by their file ID outside the lock, to keep the critical section short
+        new_files = {file_info['file']['id']: file_info for file_info in files}
+
+        # Remove stale entries before acquiring the lock of the key
+        self._prune()
+
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            self._touched[key] = time.monotonic()
+            # Create an entry for the key if it does not exist, adopting the new files index
+            existing_files = self._data.setdefault(key, new_files)
+            if existing_files is not new_files:
+                # Merge new files with existing ones, avoiding duplicates by file ID
+                for file_id, file_info in new_files.items():
+                    existing_files.setdefault(file_id, file_info)
 
     def delete_user_data(self, user_id: str, chat_id: str) -> None:
         # Construct the key for the user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = (user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for writing
-            # Remove user data from the dictionary
-            if key in self._data:
-                del self._data[key]
+        with self._lock_for(key):  # Acquire the lock for writing
+            # Remove user data from the dictionary (if any)
+            self._data.pop(key, None)
+            self._touched.pop(key, None)
 
     def get_all_data(self) -> dict:
-        with self._lock:  # Acquire the lock for writing
-            return self._data
+        # Acquire all locks (always in the same order) for a consistent snapshot
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            # Return a snapshot with a new list of files per key, so that callers never share the internal containers
+            return {key: list(files.values()) for key, files in self._data.items()}
+        finally:
+            for lock in self._locks:
+                lock.release()
 
 
 class SharedUserFilesLatestUploadDict:
     '''
     This is a class for creating a shared dictionary
     for storing the latest file upload of the users'
-    files. It uses a lock to ensure thread safety when
-    accessing the shared dictionary.
+    files. It uses striped locks, selected by key, to ensure
+    thread safety when modifying the shared dictionary,
+    while single-lookup reads are lock-free. Entries are
+    not pruned, as they are small and a chat resumed after
+    any idle time must not process its files again.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]  # Create a set of striped locks
 
-    def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
-        return_data = 0
+    def _lock_for(self, key: tuple[str, str]) -> threading.Lock:
+        # Select the lock guarding the stripe of the key
+        return self._locks[hash(key) % _LOCK_STRIPES]
 
+    def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
         # Construct the key for the user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = (user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for retrieving data
-            # Check if the key exists in the dictionary
-            if key in self._data:
-                return_data = self._data[key]
-
-        return return_data
+        # A single dictionary lookup is atomic, hence no lock is required for reading
+        return self._data.get(key, 0)
 
     def update_user_latest_timestamp(self, user_id: str, chat_id: str, timestamp: int) -> None:
         # Construct the key for the user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = (user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for inserting data
-            # Check if the key exists in the dictionary
-            if key not in self._data:
-                # User ID does not exist in the dictionary - create an entry for it
-                self._data[key] = timestamp
-            elif timestamp > self._data[key]:
-                # Update the latest timestamp of the user in the dictionary
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            # Update the latest timestamp of the user in the dictionary, if the new one is more recent
+            if timestamp > self._data.get(key, 0):
                 self._data[key] = timestamp
 
 
@@ -133,8 +189,8 @@ class Pipeline:
 
     def __init__(self):
         '''Constructor method'''
-        # Initialize OpenAI API information from environment variables through valves.
-        self.valves = self.Valves()
+        # Reuse the valves built once at module import, instead of validating them on every construction
+        self.valves = _VALVES
 
         # Enable logging and set level to DEBUG
         logger = logging.getLogger(self.valves.APP_ID)
@@ -149,6 +205,9 @@ class Pipeline:
         handlersys.setFormatter(formatter)
         logger.addHandler(handlersys)
 
+        # Keep a reference to the logger to avoid looking it up on every call
+        self.logger = logger
+
         # Initialize user file contents dictionary
         self.user_file_contents = SharedUserFilesDict()
 
@@ -160,13 +219,17 @@ class Pipeline:
             api_key=self.valves.LANGGRAPH_API_KEY,
         )
 
+        # Initialize a pool of workers for sending each user-uploaded file to the LangGraph server concurrently
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="langgraph")
+
     async def on_startup(self):
         '''This function is called when the server is started.'''
         pass
 
     async def on_shutdown(self):
         '''This function is called when the server is stopped.'''
-        pass
+        # Stop the workers, without waiting for pending LangGraph runs
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
     async def on_valves_updated(self):
         '''This function is called when the valves are updated.'''
@@ -174,7 +237,7 @@ class Pipeline:
 
     async def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies form data before the OpenAI API request.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("INLET begin:\nBody:\n%s", _LazyJson(body))
 
         if body.get("files", []):
             # Extract user ID
@@ -188,7 +251,7 @@ class Pipeline:
 
             # Store chat ID in the last message content to be passed to the Pipe method, in the format
             # "Original content\n\n\n\n\nChat ID\n\n\n\n\n<chat_id>\n\n\n\n\n"
-            body['messages'][-1]['content'] = body['messages'][-1]['content'] + f"\n\n\n\n\nChat ID\n\n\n\n\n{chat_id}\n\n\n\n\n"
+            body['messages'][-1]['content'] = f"{body['messages'][-1]['content']}{_CHAT_ID_MARKER}{chat_id}{_CHAT_ID_TERMINATOR}"
 
 
             # Retrieve the timestamp of the user's latest file uploaded
@@ -206,48 +269,43 @@ class Pipeline:
             new_files_latest_timestamp = latest_timestamp
 
 
-            file_infos = []
+            new_files = []
+
+            # Bind the list append method to a local variable, avoiding an attribute lookup per file
+            new_files_append = new_files.append
 
-            # Iterate over the whole list of uploaded files
+            # Iterate over the whole list of uploaded files once
             for file_info in body.get("files", []):
-                # Extract file information
-                file = file_info["file"]
+                # Extract the file creation timestamp
+                created_at = int(file_info["file"]["created_at"])
 
-                # Check if file was among the latest uploaded files
-                if int(file["created_at"]) > latest_timestamp:
-                    file_infos.append(file_info)
+                # Add file to the list of collected new files
+                if created_at >= latest_timestamp:
+                    new_files_append(file_info)
 
-                if int(file["created_at"]) > new_files_latest_timestamp:
+                if created_at > new_files_latest_timestamp:
                     # Update the latest timestamp of the uploaded files
-                    new_files_latest_timestamp = int(file["created_at"])
+                    new_files_latest_timestamp = created_at
 
             # Update the latest timestamp of the user in the shared dictionary
             self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, new_files_latest_timestamp)
 
-
-            new_files = []
-
-            # Extract file info for all files in the body
-            for file_info in body.get("files", []):
-                # Add file to the list of collected new files
-                if file_info["file"]["created_at"] >= latest_timestamp:
-                    new_files.append(file_info)
-
             # Keep new user files into the current user file contents
             self.user_file_contents.insert_user_files(user_id, chat_id, new_files)
 
 
             # Keep only new and acceptable files in the request body (removing previously processed and unacceptable files)
-            body["files"] = [file_info for file_info in body["files"] if file_info in new_files]
-            body["metadata"]["files"] = [file_info for file_info in body["metadata"]["files"] if file_info in new_files]
+            body["files"] = new_files
+            new_file_ids = {file_info["file"]["id"] for file_info in new_files}
+            body["metadata"]["files"] = [file_info for file_info in body["metadata"]["files"] if file_info["file"]["id"] in new_file_ids]
 
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET end")
+        self.logger.debug(f"INLET end")
 
         return body
 
     async def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies OpenAI response form data before returning them to the user.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("OUTLET begin:\nBody:\n%s", _LazyJson(body))
 
         # Extract user chat information
         chat_id = body.get('chat_id', '')
@@ -258,13 +316,13 @@ class Pipeline:
         # Delete user-uploaded data information from the shared dictionary (if any)
         self.user_file_contents.delete_user_data(user_id, chat_id)
 
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET end")
+        self.logger.debug(f"OUTLET end")
 
         return body
 
     def pipe(self, user_message: str, model_id: str, messages: list[dict], body: dict) -> Union[str, Generator, Iterator]:
         '''Custom pipeline logic (like RAG).'''
-        logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("PIPE begin:\nBody:\n%s", _LazyJson(body))
 
         return_data = ""
 
@@ -273,71 +331,111 @@ class Pipeline:
 
         # Extract chat ID from the messages
         chat_id = ''
-        if messages[-1]['content']:
+        content = messages[-1]['content']
+        if content and content.endswith(_CHAT_ID_TERMINATOR):
             # Extract chat ID from the last message content, assuming the chat ID is stored in the format
             # "Original content\n\n\n\n\nChat ID\n\n\n\n\n<chat_id>\n\n\n\n\n"
             # This is a workaround to extract the chat ID from the last message content as it was added in the inlet method.
 
-            # Split the content by triple newlines to separate the parts
-            content_parts = messages[-1]['content'].split("\n\n\n\n\n") if messages[-1]['content'] else [''] * 3
+            # Search for the marker from the end of the content only, leaving any blank lines of the original content intact
+            original_content, marker, tail = content[:-len(_CHAT_ID_TERMINATOR)].rpartition(_CHAT_ID_MARKER)
 
-            # Extract the chat ID from the content parts
-            chat_id = content_parts[2]
+            if marker:
+                # Extract the chat ID from the tail of the content
+                chat_id = tail
 
-            # Restore the original content without the chat ID
-            messages[-1]['content'] = content_parts[0]
+                # Restore the original content without the chat ID
+                messages[-1]['content'] = original_content
 
 
         # Extract user-uploaded files (if available)
         user_files = self.user_file_contents.get_user_files(user_id, chat_id)
 
         if not user_files:
-            logging.getLogger(self.valves.APP_ID).warning(f"PIPE: No input DOCX files were provided")
+            self.logger.warning(f"PIPE: No input DOCX files were provided")
             return_data = "No compatible files were uploaded. This model only supports DOCX files with UTF-8 encoding."
         else:
-            if not any(len(file_info['file']['data']['content']) for file_info in user_files):
-                logging.getLogger(self.valves.APP_ID).warning(f"PIPE: All input DOCX files are empty")
+            if not any(file_info['file']['data']['content'] for file_info in user_files):
+                self.logger.warning(f"PIPE: All input DOCX files are empty")
                 return_data = "All uploaded DOCX files are empty."
             else:
-                logging.getLogger(self.valves.APP_ID).debug(f"PIPE: User input files:\n{json.dumps([file['file']['filename'] for file in user_files], indent=2)}")
-
-                data = []
-
-                try:
-                    logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Creating thread LangGraph client thread...")
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    # Collect the file names only when the debug record is emitted
+                    self.logger.debug("PIPE: User input files:\n%s", _LazyJson([file['file']['filename'] for file in user_files]))
 
-                    thread = self.langgraph_client.threads.create(
-                        thread_id=str(uuid.uuid4()),
-                    )
+                self.logger.debug(f"PIPE: Sending user input files to the LangGraph server...")
 
+                # Stream the identified PII items of each file as soon as its LangGraph run completes
+                return_data = self._stream_files_pii(user_files)
 
-                    logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Sending user input files to the LangGraph server...")
+        self.logger.debug(f"PIPE end")
 
-                    graph_response = self.langgraph_client.runs.wait(
-                        thread["thread_id"],
-                        "agent",  # Name of assistant (defined in langgraph.json)
-                        input={
-                            'files': user_files,
-                        },
-                    )
-
-
-                    logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Extracting identified PII items from the LangGraph response...")
+        return return_data
 
-                    data = [
-                        {
-                            "id": file_pii['id'],
-                            "pii": file_pii['pii'],
-                        } for file_pii in graph_response['final_pii_items']
-                    ]
-                except Exception as e:
-                    logging.getLogger(self.valves.APP_ID).error(f"PIPE: Error processing files {json.dumps([file['file']['filename'] for file in user_files], indent=2)}: {e}")
+    def _stream_files_pii(self, user_files: list[dict]) -> Generator:
+        '''
+        Stream the identified PII items of the user-uploaded files as a
+        JSON array, yielding the items of each file as soon as its
+        LangGraph run completes, in the order of completion.
+
+        Input parameters:
+        * user_files: A list with the information of the user-uploaded files.
+
+        Yields:
+        * Parts of the JSON array with the identified PII items, or an
+          error message if the PII items of no file could be identified.
+        '''
+        # Send each user-uploaded file to the LangGraph server in its own run, concurrently
+        futures = {self.executor.submit(self._process_file, file_info): file_info for file_info in user_files}
+
+        # Open the JSON array only when the first PII item is yielded
+        separator = "["
+
+        for future in as_completed(futures):
+            try:
+                file_piis = future.result()
+            except Exception as e:
+                # Log the failed file, without discarding the results of the others
+                self.logger.error(f"PIPE: Error processing file '{futures[future]['file']['filename']}': {e}")
+                continue
+
+            for file_pii in file_piis:
+                yield separator + json.dumps(file_pii, indent=2)
+                separator = ","
+
+        if separator == "[":
+            yield "Error processing the content of uploaded DOCX files."
+        else:
+            # Close the JSON array
+            yield "]"
+
+    def _process_file(self, file_info: dict) -> list[dict]:
+        '''
+        Identify the PII items of a single user-uploaded file,
+        using a stateless LangGraph run (without a thread).
+
+        Input parameters:
+        * file_info: The information of the user-uploaded file.
+
+        Returns:
+        * A list with the identified PII items of the file.
+        '''
+        # Run the graph without creating a thread, as no state is kept between runs
+        graph_response = self.langgraph_client.runs.wait(
+            None,
+            "agent",  # Name of assistant (defined in langgraph.json)
+            input={
+                'files': [file_info],
+            },
+        )
 
-                if data:
-                    return_data = json.dumps(data, indent=2)
-                else:
-                    return_data = "Error processing the content of uploaded DOCX files."
+        return [
+            {
+                "id": file_pii['id'],
+                "pii": file_pii['pii'],
+            } for file_pii in graph_response['final_pii_items']
+        ]
 
-        logging.getLogger(self.valves.APP_ID).debug(f"PIPE end")
 
-        return return_data
\ No newline at end of file
+# Build the valves once from their environment variable defaults, skipping pydantic validation
+_VALVES = Pipeline.Valves.model_construct()
\ No newline at end of file
@@ -1,7 +1,10 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pydantic import BaseModel, Field
 from requests.adapters import HTTPAdapter
 from typing import Generator, Iterator, Optional, Union
 from urllib3.util.retry import Retry
+import hashlib
 import json
 import logging
 import os
@@ -11,6 +14,66 @@ import sys
 import threading
 
 
+try:
+    # Use the faster orjson library for JSON encoding and decoding on the request path, if available
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, indent=2)
+
+    _json_loads = json.loads
+
+
+# Number of locks guarding the shared dictionaries, so that unrelated user-chat keys do not contend
+_LOCK_STRIPES = 16
+
+# Maximum number of PII detection results kept in the cache, keyed by a hash of the analyzed text
+_PII_CACHE_SIZE = 1024
+
+# Content types of the user-uploaded files which can be processed (DOCX documents)
+_ACCEPTABLE_CONTENT_TYPES = frozenset({
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+})
+
+# Marker and terminator wrapping the chat ID appended to the last user message, as
+# Open WebUI does not forward the request metadata (and thus the chat ID) to the Pipe method
+_CHAT_ID_MARKER = "\n\n\n\n\nChat ID\n\n\n\n\n"
+_CHAT_ID_TERMINATOR = "\n\n\n\n\n"
+
+# Translation table replacing tabs with spaces in the content of user-uploaded files
+_TABS_TO_SPACES = str.maketrans('\t', ' ')
+
+# Compiled pattern matching runs of spaces, optionally followed by consecutive newlines
+_WHITESPACE_PATTERN = re.compile(r' *\n+| +')
+
+
+def _collapse_whitespace(match: re.Match) -> str:
+    # Collapse newlines (with any preceding spaces) into a single newline preceded by a space,
+    # and multiple consecutive spaces into a single space
+    return ' \n' if match.group()[-1] == '\n' else ' '
+
+
+class _LazyJson:
+    '''
+    This is a class for deferring the JSON serialization
+    of an object until it is formatted by the logging
+    module, so that no serialization takes place for log
+    records which are not emitted.
+    '''
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return _json_dumps(self.obj)
+
+
 class OIFile:
     '''
     This is a class for representing a user-uploaded
@@ -37,14 +100,12 @@ class OIFile:
         return f"File(id={self.id}, name={self.name}, size={self.size} bytes)"
 
     def _build_document(self, text: str) -> str:
-        # First normalize consecutive newlines to single newlines
-        document = re.sub(r'\n+', ' \n', text)
-
         # Replace tabs with spaces
-        document = re.sub(r'\t', ' ', document)
+        document = text.translate(_TABS_TO_SPACES)
 
-        # Replace multiple consecutive spaces with a single space
-        document = re.sub(r' +', ' ', document)
+        # Normalize consecutive newlines to single newlines and multiple
+        # consecutive spaces to a single space, in a single pass
+        document = _WHITESPACE_PATTERN.sub(_collapse_whitespace, document)
 
         return document
 
@@ -82,82 +143,72 @@ class SharedUserFilesDict:
     '''
     This is a class for creating a shared dictionary
     for storing information on the latest user-uploaded
-    files. It uses a lock to ensure thread safety when
-    accessing the shared dictionary.
+    files. It relies on single dictionary operations,
+    which are atomic, to ensure thread safety when
+    accessing the shared dictionary without a lock.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
 
     def get_user_files(self, user_id: str, chat_id: str) -> dict:
-        return_data = {}
-
         # Construct the key for the user_id and chat_id
         key = f'{user_id}_{chat_id}'
 
-        with self._lock:  # Acquire the lock for retrieving data
-            # Check if the key exists in the dictionary
-            if key in self._data:
-                return_data = self._data[key]
-
-        return return_data
+        # Retrieve the user files (if any) with a single atomic lookup
+        return self._data.get(key, {})
 
     def insert_user_files(self, user_id: str, chat_id: str, files: dict) -> None:
         # Construct the key for the user_id and chat_id
         key = f'{user_id}_{chat_id}'
 
-        with self._lock:  # Acquire the lock for inserting data
-            # Check if the key exists in the dictionary
-            if key not in self._data:
-                self._data[key] = {}
-            for k, v in files.items():
-                if k not in self._data[key]:
-                    self._data[key][k] = v
+        # Create an entry for the key if it does not exist, with a single atomic operation
+        user_files = self._data.setdefault(key, {})
+
+        # Insert the new files, keeping any existing files with the same ID
+        for k, v in files.items():
+            user_files.setdefault(k, v)
 
     def delete_user_data(self, user_id: str, chat_id: str) -> None:
         # Construct the key for the user_id and chat_id
         key = f'{user_id}_{chat_id}'
 
-        with self._lock:  # Acquire the lock for writing
-            # Check if the user_id exists in the dictionary
-            if key in self._data:
-                # Remove user data from the dictionary
-                del self._data[key]
+        # Remove user data from the dictionary (if any) with a single atomic operation
+        self._data.pop(key, None)
 
     def get_all_data(self) -> dict:
-        with self._lock:  # Acquire the lock for writing
-            return dict(self._data)
+        # Copying the dictionary is a single atomic operation
+        return self._data.copy()
 
 
 class SharedUserFilesLatestUploadDict:
     '''
     This is a class for creating a shared dictionary
     for storing the latest file upload of the users'
-    files. It uses a lock to ensure thread safety when
-    accessing the shared dictionary.
+    files. It uses striped locks, selected by key, to
+    ensure thread safety when updating a timestamp, which
+    requires a comparison with the stored one, while reads
+    are lock-free.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]  # Create a set of striped locks
 
-    def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
-        return_data = 0
+    def _lock_for(self, key: str) -> threading.Lock:
+        # Select the lock guarding the stripe of the key
+        return self._locks[hash(key) % _LOCK_STRIPES]
 
+    def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
         # Construct the key for the user_id and chat_id
         key = f'{user_id}_{chat_id}'
 
-        with self._lock:  # Acquire the lock for retrieving data
-            # Check if the key exists in the dictionary
-            if key in self._data:
-                return_data = self._data[key]
-
-        return return_data
+        # A single dictionary lookup is atomic, hence no lock is required for reading
+        return self._data.get(key, 0)
 
     def update_user_latest_timestamp(self, user_id: str, chat_id: str, timestamp: int) -> None:
         # Construct the key for the user_id and chat_id
         key = f'{user_id}_{chat_id}'
 
-        with self._lock:  # Acquire the lock for inserting data
+        with self._lock_for(key):  # Acquire the lock for inserting data
             # Check if the key exists in the dictionary
             if key not in self._data:
                 # User ID does not exist in the dictionary - create an entry for it
@@ -220,6 +271,9 @@ class Pipeline:
         handlersys.setFormatter(formatter)
         logger.addHandler(handlersys)
 
+        # Keep a reference to the logger to avoid looking it up on every call
+        self.logger = logger
+
         # Initialize user file contents dictionary
         self.user_file_contents = SharedUserFilesDict()
 
@@ -235,6 +289,16 @@ class Pipeline:
             "Content-Type": "application/json",
         }
 
+        # Initialize an HTTP session reused across requests, keeping connections to the LLM service alive
+        self.session = self._create_session(max_retries=5, wait_interval=10)
+
+        # Initialize a pool of workers for sending the requests of multiple files to the LLM service concurrently
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pii")
+
+        # Initialize a bounded LRU cache of PII detection results, so that re-uploaded content skips the LLM call
+        self._pii_cache = OrderedDict()
+        self._pii_cache_lock = threading.Lock()
+
         self.system_prompt = '''
             You are a GDPR-compliant data privacy assistant. Your role is to detect Personally Identifiable Information (PII) in provided text based on the EU’s General Data Protection Regulation (GDPR).
 
@@ -248,8 +312,8 @@ class Pipeline:
 
             Maintain strict compliance with GDPR’s definition of personal data as described in Article 4(1).
 
-            Output results in structured JSON array format, suitable for downstream processing.
-            If no PII is identified, return an empty JSON array.
+            Output results as a JSON object with a "pii" key holding a structured JSON array, suitable for downstream processing.
+            If no PII is identified, return an empty JSON array under the "pii" key.
         '''
 
         self.user_prompt_template = '''
@@ -266,14 +330,16 @@ class Pipeline:
             - type: The PII identifier type (direct or indirect)
             - justification: The justification for PII classification
 
-            Format your results as a structured JSON array, where each object in the array represents one PII instance.
-            If no PII is identified, return an empty JSON array.
+            Format your results as a JSON object with a "pii" key holding a structured JSON array, where each object in the array represents one PII instance.
+            If no PII is identified, return an empty JSON array under the "pii" key.
 
             Example:
-            [
-                {{"text": "John Doe", "category": "name", "type": "direct", "justification": "Identifies an individual directly."}},
-                {{"text": "d.joe@brand.co", "category": "email", "type": "direct", "justification": "Identifies an individual directly through their email address."}}
-            ]
+            {{
+                "pii": [
+                    {{"text": "John Doe", "category": "name", "type": "direct", "justification": "Identifies an individual directly."}},
+                    {{"text": "d.joe@brand.co", "category": "email", "type": "direct", "justification": "Identifies an individual directly through their email address."}}
+                ]
+            }}
         '''
 
     async def on_startup(self):
@@ -282,7 +348,11 @@ class Pipeline:
 
     async def on_shutdown(self):
         '''This function is called when the server is stopped.'''
-        pass
+        # Stop the workers, without waiting for pending requests
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        # Close the HTTP session and its pooled connections
+        self.session.close()
 
     async def on_valves_updated(self):
         '''This function is called when the valves are updated.'''
@@ -290,7 +360,7 @@ class Pipeline:
 
     async def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies form data before the OpenAI API request.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("INLET begin:\nBody:\n%s", _LazyJson(body))
 
         if body.get("files", []):
             # Extract user ID
@@ -304,7 +374,7 @@ class Pipeline:
 
             # Store chat ID in the last message content to be passed to the Pipe method, in the format
             # "Original content\n\n\n\n\nChat ID\n\n\n\n\n<chat_id>\n\n\n\n\n"
-            body['messages'][-1]['content'] = body['messages'][-1]['content'] + f"\n\n\n\n\nChat ID\n\n\n\n\n{chat_id}\n\n\n\n\n"
+            body['messages'][-1]['content'] = f"{body['messages'][-1]['content']}{_CHAT_ID_MARKER}{chat_id}{_CHAT_ID_TERMINATOR}"
 
 
             # Retrieve the timestamp of the user's latest file uploaded
@@ -318,24 +388,17 @@ class Pipeline:
                 # Update the latest timestamp of the user in the shared dictionary
                 self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, latest_timestamp)
 
-            # Keep a copy of the timestamp of the user's latest file uploaded
-            new_files_latest_timestamp = latest_timestamp
-
+            # Parse the creation timestamp of each uploaded file once
+            files_created_at = [(int(file_info["file"]["created_at"]), file_info) for file_info in body.get("files", [])]
 
-            file_infos = []
+            # Collect the files which were among the latest uploaded files
+            file_infos = [file_info for created_at, file_info in files_created_at if created_at > latest_timestamp]
 
-            # Iterate over the whole list of uploaded files
-            for file_info in body.get("files", []):
-                # Extract file information
-                file = file_info["file"]
-
-                # Check if file was among the latest uploaded files
-                if int(file["created_at"]) > latest_timestamp:
-                    file_infos.append(file_info)
-
-                if int(file["created_at"]) > new_files_latest_timestamp:
-                    # Update the latest timestamp of the uploaded files
-                    new_files_latest_timestamp = int(file["created_at"])
+            # Compute the latest timestamp of the uploaded files (never older than the user's latest timestamp)
+            new_files_latest_timestamp = max(
+                (created_at for created_at, _ in files_created_at if created_at > latest_timestamp),
+                default=latest_timestamp,
+            )
 
             # Update the latest timestamp of the user in the shared dictionary
             self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, new_files_latest_timestamp)
@@ -348,22 +411,26 @@ class Pipeline:
                 # Add file to the list of collected new files
                 new_files[file.get_id()] = file
 
-            logging.getLogger(self.valves.APP_ID).debug(f"INLET: User-uploaded files '{new_files}'")
+            self.logger.debug("INLET: User-uploaded files '%s'", new_files)
 
             # Keep new user files into the current user file contents
             self.user_file_contents.insert_user_files(user_id, chat_id, new_files)
 
             # Keep only new and acceptable files in the request body (removing previously processed and unacceptable files)
             body["files"] = [file_info for file_info in body["files"] if file_info["file"]["id"] in new_files]
-            body["metadata"]["files"] = [file_info for file_info in body["metadata"]["files"] if file_info["file"]["id"] in new_files]
 
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET end")
+            # Filter the metadata files only if present, looking up the same dictionary of new files
+            metadata_files = body.get("metadata", {}).get("files")
+            if metadata_files is not None:
+                body["metadata"]["files"] = [file_info for file_info in metadata_files if file_info["file"]["id"] in new_files]
+
+        self.logger.debug(f"INLET end")
 
         return body
 
     async def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies OpenAI response form data before returning them to the user.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("OUTLET begin:\nBody:\n%s", _LazyJson(body))
 
         # Extract user chat information
         chat_id = body.get('chat_id', '')
@@ -374,13 +441,13 @@ class Pipeline:
         # Delete user-uploaded data information from the shared dictionary (if any)
         self.user_file_contents.delete_user_data(user_id, chat_id)
 
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET end")
+        self.logger.debug(f"OUTLET end")
 
         return body
 
     def pipe(self, user_message: str, model_id: str, messages: list[dict], body: dict) -> Union[str, Generator, Iterator]:
         '''Custom pipeline logic (like RAG).'''
-        logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin:\nBody:\n{json.dumps(body, indent=2)}")
+        self.logger.debug("PIPE begin:\nBody:\n%s", _LazyJson(body))
 
         return_data = ""
 
@@ -389,62 +456,161 @@ class Pipeline:
 
         # Extract chat ID from the messages
         chat_id = ''
-        if messages[-1]['content']:
+        content = messages[-1]['content']
+        if content and content.endswith(_CHAT_ID_TERMINATOR):
             # Extract chat ID from the last message content, assuming the chat ID is stored in the format
             # "Original content\n\n\n\n\nChat ID\n\n\n\n\n<chat_id>\n\n\n\n\n"
             # This is a workaround to extract the chat ID from the last message content as it was added in the inlet method.
 
-            # Split the content by triple newlines to separate the parts
-            content_parts = messages[-1]['content'].split("\n\n\n\n\n") if messages[-1]['content'] else [''] * 3
+            # Search for the marker from the end of the content only, leaving any blank lines of the original content intact
+            original_content, marker, tail = content[:-len(_CHAT_ID_TERMINATOR)].rpartition(_CHAT_ID_MARKER)
 
-            # Extract the chat ID from the content parts
-            chat_id = content_parts[2]
+            if marker:
+                # Extract the chat ID from the tail of the content
+                chat_id = tail
 
-            # Restore the original content without the chat ID
-            messages[-1]['content'] = content_parts[0]
+                # Restore the original content without the chat ID
+                messages[-1]['content'] = original_content
 
 
         # Extract user-uploaded files (if available)
         user_files = self.user_file_contents.get_user_files(user_id, chat_id)
 
         if not user_files:
-            logging.getLogger(self.valves.APP_ID).warning(f"PIPE: No input DOCX files were provided")
+            self.logger.warning(f"PIPE: No input DOCX files were provided")
             return_data = "No compatible files were uploaded. This model only supports DOCX files with UTF-8 encoding."
         else:
             if not any(user_file.get_size() for user_file in user_files.values()):
-                logging.getLogger(self.valves.APP_ID).warning(f"PIPE: All input DOCX files are empty")
+                self.logger.warning(f"PIPE: All input DOCX files are empty")
                 return_data = "All uploaded DOCX files are empty."
             else:
-                logging.getLogger(self.valves.APP_ID).debug(f"PIPE: User input files:\n{user_files}")
+                self.logger.debug("PIPE: User input files:\n%s", user_files)
+
+                # Stream the identified PII items of each file as soon as they are retrieved
+                return_data = self._stream_files_pii(user_files)
+
+        self.logger.debug(f"PIPE end")
+
+        return return_data
+
+    def _stream_files_pii(self, user_files: dict) -> Generator:
+        '''
+        This function streams the identified PII of the user-uploaded files as a JSON array.
+
+        It splits the content of each non-empty file into overlapping chunks, sends the requests of
+        all chunks to the model concurrently, and yields the PII of each file as soon as the PII of
+        all its chunks are retrieved, so that the results of the first files are displayed before
+        the processing of all files completes.
+
+        Input parameters:
+        * user_files: A dictionary of the user-uploaded files, indexed by file ID.
+        Yields:
+        * Parts of the JSON array with the identified PII, or an error message if the PII of no file could be retrieved.
+        '''
+        futures = {}
+
+        # PII of the chunks of each file (in the order of the chunks), indexed by file ID
+        chunks_pii = {}
+
+        for file_id, file in user_files.items():
+            if file.get_size():
+                self.logger.debug(f"PIPE: Getting model file pii...")
+
+                chunks = list(self._chunk_text(file.get_content()))
+                chunks_pii[file.get_id()] = [None] * len(chunks)
+
+                # Send the request of each chunk of the file to the LLM service in the background
+                for index, chunk in enumerate(chunks):
+                    futures[self.executor.submit(self._get_pii, chunk)] = (file, index)
+            else:
+                self.logger.warning(f"PIPE: File {file.get_name()} is empty")
+
+        # Open the JSON array only when the PII of the first file is yielded
+        separator = "["
+
+        for future in as_completed(futures):
+            file, index = futures[future]
+
+            # Skip the remaining chunks of a file whose processing already failed
+            file_chunks_pii = chunks_pii.get(file.get_id())
+            if file_chunks_pii is None:
+                continue
+
+            try:
+                file_chunks_pii[index] = future.result()
+            except Exception as e:
+                self.logger.error(f"PIPE: Error processing file {file.get_name()}: {e}")
+                del chunks_pii[file.get_id()]
+                continue
+
+            # Yield the PII of the file once the PII of all its chunks are retrieved
+            if all(chunk_pii is not None for chunk_pii in file_chunks_pii):
+                yield separator + _json_dumps(
+                    {
+                        "id": file.get_id(),
+                        "pii": self._merge_pii(file_chunks_pii),
+                    }
+                )
+                separator = ","
 
-                data = []
+        if separator == "[":
+            yield "Error processing the content of uploaded DOCX files."
+        else:
+            # Close the JSON array
+            yield "]"
 
-                for file_id, file in user_files.items():
-                    if file.get_size():
-                        try:
-                            logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Getting model file pii...")
+    def _chunk_text(self, text: str, chunk_chars: int=8000, overlap: int=400) -> Generator:
+        '''
+        This function splits the provided text into overlapping chunks.
 
-                            pii = self._get_pii(file.get_content())
+        Consecutive chunks share their boundary characters, so that a PII instance which is split
+        at the end of a chunk appears in full at the beginning of the next one. Texts which fit in
+        a single chunk are not split.
 
-                            data.append(
-                                {
-                                    "id": file.get_id(),
-                                    "pii": pii,
-                                }
-                            )
-                        except Exception as e:
-                            logging.getLogger(self.valves.APP_ID).error(f"PIPE: Error processing file {file.get_name()}: {e}")
-                    else:
-                        logging.getLogger(self.valves.APP_ID).warning(f"PIPE: File {file.get_name()} is empty")
+        Input parameters:
+        * text: The text to be split.
+        * chunk_chars: The maximum number of characters of each chunk.
+        * overlap: The number of characters shared by consecutive chunks.
+        Yields:
+        * The chunks of the text.
+        '''
+        step = chunk_chars - overlap
 
-                if data:
-                    return_data = json.dumps(data, indent=2)
-                else:
-                    return_data = "Error processing the content of uploaded DOCX files."
+        for start in range(0, max(len(text) - overlap, 1), step):
+            yield text[start:start + chunk_chars]
 
-        logging.getLogger(self.valves.APP_ID).debug(f"PIPE end")
+    def _merge_pii(self, chunks_pii: list) -> list | str:
+        '''
+        This function merges the PII identified in the chunks of a text.
 
-        return return_data
+        PII instances identified in more than one chunk (such as those in the overlap of consecutive
+        chunks) are kept once, based on their text and category. If the PII of any chunk could not be
+        identified, the error message of that chunk is returned instead.
+
+        Input parameters:
+        * chunks_pii: A list with the identified PII of each chunk, in the order of the chunks.
+        Returns:
+        * The merged identified PII.
+        '''
+        # Return the PII of single-chunk texts as they are
+        if len(chunks_pii) == 1:
+            return chunks_pii[0]
+
+        merged_pii = []
+        seen = set()
+
+        for chunk_pii in chunks_pii:
+            if not isinstance(chunk_pii, list):
+                # Return the error message of the chunk
+                return chunk_pii
+
+            for pii in chunk_pii:
+                key = (pii.get('text'), pii.get('category')) if isinstance(pii, dict) else (str(pii), None)
+                if key not in seen:
+                    seen.add(key)
+                    merged_pii.append(pii)
+
+        return merged_pii
 
     def _extract_body_files(self, data: dict | list) -> list[OIFile]:
         '''
@@ -461,30 +627,19 @@ class Pipeline:
         Returns:
         * A list of OIFile instances representing the user-uploaded files.
         '''
-        oifiles = []
-
-        if isinstance(data, dict):
-            # If inlet_body is a dictionary (full inlet body), extract the "files" key
-            files_entries = data.get("files", [])
-        elif isinstance(data, list):
-            # If inlet_body is a list (extracted "files" from inlet body), use it directly
-            files_entries = data
-
-        for entry in files_entries:
-            file_info = entry.get("file", {})
-            if file_info:
-                # Only process DOCX files
-                if file_info['meta']['content_type'] == \
-                    'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-                    # Create an OIFile instance and append it to the list
-                    oifiles.append(
-                        OIFile(file_info['id'], file_info['filename'], file_info['data']['content'])
-                    )
+        # If data is a dictionary (full inlet body), extract the "files" key, otherwise
+        # data is a list (extracted "files" from inlet body), hence use it directly
+        files_entries = data.get("files", []) if type(data) is dict else data
 
-        return oifiles
+        # Create an OIFile instance for each DOCX file only
+        return [
+            OIFile(file_info['id'], file_info['filename'], file_info['data']['content'])
+            for entry in files_entries
+            if (file_info := entry.get("file", {})) and file_info['meta']['content_type'] in _ACCEPTABLE_CONTENT_TYPES
+        ]
 
     # Change from async function to regular function
-    def _get_pii(self, text: str, max_retries: int=5, wait_interval: int=10) -> dict | str:
+    def _get_pii(self, text: str) -> dict | str:
         '''
         This function sends a request to the OpenAI API to get a the PII within the provided text.
         If the text is empty, it returns a message indicating that no content was provided.
@@ -502,102 +657,110 @@ class Pipeline:
         else:
             # Check API key before making request
             if not self.valves.LITELLM_API_KEY:
-                logging.getLogger(self.valves.APP_ID).error(f"_get_pii: Invalid API key configuration")
+                self.logger.error(f"_get_pii: Invalid API key configuration")
                 pii = "Error: API key not properly configured. Please set a valid LITELLM_API_KEY environment variable."
             else:
-                if self._check_litellm_status():
-                    logging.getLogger(self.valves.APP_ID).debug(f"_get_pii: LiteLLM service is running")
-
-                    # Create LLM PII detection payload
-                    identification_payload = {
-                        "model": self.valves.MODEL_ID,
-                        "messages": [
-                            {"role": "system", "content": self.system_prompt},
-                            {"role": "user", "content": self.user_prompt_template.format(text=text)}
-                        ],
-                        "temperature": 0.1,
-                        "stream": False,
-                    }
-
-                    # Log request info (without sensitive data)
-                    masked_headers = dict(self.http_headers)
-                    if "Authorization" in masked_headers:
-                        masked_headers["Authorization"] = "Bearer sk-****"
-                    logging.getLogger(self.valves.APP_ID).debug(
-                        f"_get_pii: Sending request to {self.service_url} with masked headers {masked_headers}"
+                # Key the cache by the model and a hash of the text, as the detected PII depends on both
+                cache_key = hashlib.blake2b(f"{self.valves.MODEL_ID}\0{text}".encode(), digest_size=16).digest()
+
+                with self._pii_cache_lock:
+                    cached_pii = self._pii_cache.get(cache_key)
+                    if cached_pii is not None:
+                        self._pii_cache.move_to_end(cache_key)
+
+                if cached_pii is not None:
+                    self.logger.debug(f"_get_pii: Returning cached PII")
+                    return cached_pii
+
+                # Create LLM PII detection payload
+                identification_payload = {
+                    "model": self.valves.MODEL_ID,
+                    "messages": [
+                        {"role": "system", "content": self.system_prompt},
+                        {"role": "user", "content": self.user_prompt_template.format(text=text)}
+                    ],
+                    "temperature": 0.1,
+                    "stream": False,
+                    # Request JSON mode, so that the model responds with a raw JSON object (without Markdown code fences)
+                    "response_format": {"type": "json_object"},
+                }
+
+                # Log request info (without sensitive data)
+                masked_headers = dict(self.http_headers)
+                if "Authorization" in masked_headers:
+                    masked_headers["Authorization"] = "Bearer sk-****"
+                self.logger.debug(
+                    f"_get_pii: Sending request to {self.service_url} with masked headers {masked_headers}"
+                )
+
+                try:
+                    # Try primary service, reusing the session with proper retry handling
+                    response = self.session.post(
+                        self.service_url,
+                        headers=self.http_headers,
+                        json=identification_payload,
+                        timeout=60,
+                        proxies={"http": "", "https": ""}  # Explicitly bypass proxies
                     )
 
-                    try:
-                        # Create a session with proper retry handling
-                        session = requests.Session()
-                        session.trust_env = False  # Ignore environment variables
-                        retries = Retry(
-                            total=max_retries,
-                            backoff_factor=wait_interval,
-                            status_forcelist=[429, 500, 502, 503, 504],
-                            allowed_methods=frozenset(['POST'])  # Add POST method
-                        )
-                        adapter = HTTPAdapter(max_retries=retries)
-                        session.mount('http://', adapter)
-                        session.mount('https://', adapter)
-
-                        # Try primary service
-                        response = session.post(
-                            self.service_url,
-                            headers=self.http_headers,
-                            json=identification_payload,
-                            timeout=60,
-                            proxies={"http": "", "https": ""}  # Explicitly bypass proxies
-                        )
-
-                        # Process response as before
-                        if response.status_code == 200:
-                            res = response.json()
-                            content = res["choices"][0]["message"]["content"]
-                            if content.startswith("```json\n") and content.endswith("\n```"):
-                                content = content.replace("```json\n", "").replace("\n```", "")
-                            pii = json.loads(content)
-                        elif response.status_code == 401:
-                            logging.getLogger(self.valves.APP_ID).error(f"_get_pii: Authentication error: {response.text}")
-                            pii = "Error: Authentication failed with the LLM service. Please check your API key."
-                        else:
-                            logging.getLogger(self.valves.APP_ID).error(
-                                f"_get_pii: HTTP Error {response.status_code}: {response.text}"
-                            )
-                            pii = f"_get_pii: Error: Service returned status code {response.status_code}"
-                    except requests.exceptions.ConnectionError as e:
-                        # Connection failed - log the issue
-                        logging.getLogger(self.valves.APP_ID).error(
-                            f"Failed to connect to LiteLLM at {self.service_url}: {e}"
+                    # Process response as before
+                    if response.status_code == 200:
+                        res = _json_loads(response.content)
+                        # Unwrap the identified PII from the JSON object of the model response
+                        pii = _json_loads(res["choices"][0]["message"]["content"])["pii"]
+
+                        # Cache the successfully detected PII, evicting the least recently used entry if full
+                        with self._pii_cache_lock:
+                            self._pii_cache[cache_key] = pii
+                            if len(self._pii_cache) > _PII_CACHE_SIZE:
+                                self._pii_cache.popitem(last=False)
+                    elif response.status_code == 401:
+                        self.logger.error(f"_get_pii: Authentication error: {response.text}")
+                        pii = "Error: Authentication failed with the LLM service. Please check your API key."
+                    else:
+                        self.logger.error(
+                            f"_get_pii: HTTP Error {response.status_code}: {response.text}"
                         )
-                        pii = "Error: Could not connect to LLM service. Please try again later."
-                    except json.JSONDecodeError as e:
-                        logging.getLogger(self.valves.APP_ID).error(f"_get_pii: JSON decode error: {e}")
-                        pii = f"Error processing text: {e}"
-                    except Exception as e:
-                        logging.getLogger(self.valves.APP_ID).error(f"_get_pii: Error processing text: {e}")
-                        pii = f"Error processing text"
+                        pii = f"_get_pii: Error: Service returned status code {response.status_code}"
+                except requests.exceptions.ConnectionError as e:
+                    # Connection failed - log the issue
+                    self.logger.error(
+                        f"Failed to connect to LiteLLM at {self.service_url}: {e}"
+                    )
+                    pii = "Error: Could not connect to LLM service. Please try again later."
+                except json.JSONDecodeError as e:
+                    self.logger.error(f"_get_pii: JSON decode error: {e}")
+                    pii = f"Error processing text: {e}"
+                except Exception as e:
+                    self.logger.error(f"_get_pii: Error processing text: {e}")
+                    pii = f"Error processing text"
 
         return pii
 
-    def _check_litellm_status(self) -> bool:
-        """Check if LiteLLM server is running"""
-        url = f"{self.valves.LITELLM_API_BASE_URL.rstrip('/').rstrip('/v1')}/health"
+    def _create_session(self, max_retries: int=0, wait_interval: int=0) -> requests.Session:
+        '''
+        This function creates an HTTP session for the requests to the LiteLLM service.
 
-        try:
-            # Disable any proxy settings that might interfere
-            local_session = requests.Session()
-            local_session.trust_env = False  # Ignore environment variables
+        The session ignores environment variables (such as proxy settings) and keeps a pool of
+        connections alive, so that consecutive requests do not repeat the TCP and TLS handshakes.
+        If retries are requested, failed POST requests are retried with an exponential backoff.
 
-            response = local_session.get(
-                url=url,
-                headers=self.http_headers,
-                timeout=20,
-                proxies={"http": "", "https": ""}  # Explicitly bypass proxies
-            )
-            logging.getLogger(self.valves.APP_ID).debug(f"_check_litellm_status: LiteLLM status check: {response.status_code}")
-            return response.status_code == 200
-        except requests.exceptions.ConnectionError as e:
-            logging.getLogger(self.valves.APP_ID).error(f"_check_litellm_status: Failed to connect to LiteLLM at {url}: {e}")
-            logging.getLogger(self.valves.APP_ID).error(f"_check_litellm_status: LiteLLM service is not running or unreachable.")
-            return False
\ No newline at end of file
+        Input parameters:
+        * max_retries: The maximum number of retries of a failed request.
+        * wait_interval: The backoff factor (in seconds) between retries.
+        Returns:
+        * The HTTP session.
+        '''
+        session = requests.Session()
+        session.trust_env = False  # Ignore environment variables
+        retries = Retry(
+            total=max_retries,
+            backoff_factor=wait_interval,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['POST'])  # Add POST method
+        )
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=16)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
\ No newline at end of file
@@ -7,87 +7,184 @@ import logging
 import os
 import sys
 import threading
-import uuid
+import time
+
+
+try:
+    # Use the faster orjson library for JSON encoding and decoding on the request path, if available
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+
+# Number of locks guarding the shared dictionaries, so that unrelated user-chat keys do not contend
+_LOCK_STRIPES = 16
+
+# Stream handler for logging, built once and shared by all instances of the pipeline
+_LOG_HANDLER = logging.StreamHandler(stream=sys.stdout)
+_LOG_HANDLER.setFormatter(logging.Formatter(
+    fmt='%(asctime)s + %(levelname)-8s + %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+))
+
+# Time (in seconds) after its last write for which an entry is kept in the shared dictionaries,
+# so that entries of abandoned chats do not accumulate, and interval (in seconds) between prunings
+_ENTRY_TTL = 24 * 60 * 60
+_PRUNE_INTERVAL = 10 * 60
+
+
+def _user_chat_key(user_id: str, chat_id: str) -> tuple[str, str]:
+    # Build the index key of the shared dictionaries, combining user_id and chat_id into a tuple,
+    # which avoids allocating a new string and cannot collide when either ID contains an underscore
+    return (user_id, chat_id)
 
 
 class SharedUserFilesLatestUploadDict:
     '''
     This is a class for creating a shared dictionary for
     storing the latest uploaded files for each user-chat
-    combination. It uses a lock to ensure thread safety
-    when accessing the shared dictionary.
+    combination. It uses striped locks, selected by key, to
+    ensure thread safety when updating the shared dictionary,
+    while reads are lock-free. Entries are not pruned, as
+    they are small and a chat resumed after any idle time
+    must not process its files again.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]  # Create a set of striped locks
+
+    def _lock_for(self, key: tuple[str, str]) -> threading.Lock:
+        # Select the lock guarding the stripe of the key
+        return self._locks[hash(key) % _LOCK_STRIPES]
 
     def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
         # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
-
-        with self._lock:  # Acquire the lock for retrieving data
-            # If key exists in the dictionary, return its value, otherwise return 0
-            return_data = self._data.get(key, 0)
+        key = _user_chat_key(user_id, chat_id)
 
-        return return_data
+        # A single dictionary lookup is atomic under the GIL, hence no lock is required for reading
+        # If key exists in the dictionary, return its value, otherwise return 0
+        return self._data.get(key, 0)
 
     def update_user_latest_timestamp(self, user_id: str, chat_id: str, timestamp: int) -> None:
         # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = _user_chat_key(user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for inserting data
-            # If key exists in the dictionary, compare update its value to the timestamp
-            if timestamp > self._data.setdefault(key, 0):
+        # Skip the lock if the stored timestamp is already newer, as timestamps only increase
+        if timestamp <= self._data.get(key, 0):
+            return
+
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            # Compare the stored value (if any) to the timestamp, without inserting missing keys
+            if timestamp > self._data.get(key, 0):
                 # Update latest timestamp
                 self._data[key] = timestamp
 
+    def update_and_get_user_latest_timestamp(self, user_id: str, chat_id: str, timestamp: int) -> int:
+        # Construct index key combining user_id and chat_id
+        key = _user_chat_key(user_id, chat_id)
+
+        # Skip the lock if the stored timestamp is already newer, as timestamps only increase
+        latest_timestamp = self._data.get(key, 0)
+        if timestamp <= latest_timestamp:
+            return latest_timestamp
+
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            # Compare the stored value (if any) to the timestamp, keeping the latest of the two
+            latest_timestamp = self._data.get(key, 0)
+            if timestamp > latest_timestamp:
+                # Update latest timestamp
+                self._data[key] = latest_timestamp = timestamp
+
+        return latest_timestamp
+
 class SharedUserFilesDict:
     '''
     This is a class for creating a shared dictionary
     for storing the latest file upload timestamp for
-    each user-chat combination. It uses a lock to ensure
-    thread safety when accessing the shared dictionary.
+    each user-chat combination. It uses striped locks, selected
+    by key, to ensure thread safety when accessing the shared
+    dictionary. Entries which are not written for a day are
+    pruned lazily on writes.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._touched = dict()  # Dictionary to store the time of the latest write of each entry
+        self._next_prune = time.monotonic() + _PRUNE_INTERVAL
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]  # Create a set of striped locks
+
+    def _lock_for(self, key: tuple[str, str]) -> threading.Lock:
+        # Select the lock guarding the stripe of the key
+        return self._locks[hash(key) % _LOCK_STRIPES]
+
+    def _prune(self) -> None:
+        # Remove entries which have not been written for longer than their time-to-live, at most once per interval
+        now = time.monotonic()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + _PRUNE_INTERVAL
+
+        cutoff = now - _ENTRY_TTL
+        for key, touched in list(self._touched.items()):
+            if touched < cutoff:
+                with self._lock_for(key):  # Acquire the lock for writing
+                    # Check again under the lock, as the entry may have been written in the meantime
+                    if self._touched.get(key, now) < cutoff:
+                        self._data.pop(key, None)
+                        self._touched.pop(key, None)
 
     def add_user_file_info(self, user_id: str, chat_id: str, file_info: dict[str, Any]) -> None:
         # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = _user_chat_key(user_id, chat_id)
+
+        # Remove stale entries before acquiring the lock of the key
+        self._prune()
 
-        with self._lock:  # Acquire the lock for inserting data
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            self._touched[key] = time.monotonic()
             # Update file name
             self._data.setdefault(key, []).append(file_info)
 
     def add_user_file_infos(self, user_id: str, chat_id: str, file_infos: list[dict[str, Any]]) -> None:
         # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = _user_chat_key(user_id, chat_id)
+
+        # Remove stale entries before acquiring the lock of the key
+        self._prune()
 
-        with self._lock:  # Acquire the lock for inserting data
+        with self._lock_for(key):  # Acquire the lock for inserting data
+            self._touched[key] = time.monotonic()
             # Update file name
             self._data.setdefault(key, []).extend(file_infos)
 
-    def get_user_files_info(self, user_id: str, chat_id: str) -> list[dict[str, Any]]:
+    def get_user_files_info(self, user_id: str, chat_id: str) -> tuple[dict[str, Any], ...]:
         return_data = None
 
         # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = _user_chat_key(user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for retrieving data
-            # If key exists in the dictionary, return its value, otherwise return 0
-            return_data = self._data.get(key, [])
+        with self._lock_for(key):  # Acquire the lock for retrieving data
+            # If key exists in the dictionary, return a snapshot of its value, otherwise return an empty tuple,
+            # so that callers can iterate without racing concurrent appends
+            file_infos = self._data.get(key)
+            return_data = tuple(file_infos) if file_infos else ()
 
         return return_data
 
     def clear_user_files_info(self, user_id: str, chat_id: str) -> None:
         # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        key = _user_chat_key(user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for clearing data
+        with self._lock_for(key):  # Acquire the lock for clearing data
             # Clear user files info
             if key in self._data:
                 del self._data[key]
+            self._touched.pop(key, None)
 
 class Pipeline:
     '''
@@ -126,14 +223,12 @@ class Pipeline:
         logger = logging.getLogger(self.valves.APP_ID)
         logger.setLevel(logging.DEBUG)
 
-        # Set logging parameters
-        formatter = logging.Formatter(
-            fmt='%(asctime)s + %(levelname)-8s + %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        handlersys = logging.StreamHandler(stream=sys.stdout)
-        handlersys.setFormatter(formatter)
-        logger.addHandler(handlersys)
+        # Attach the shared stream handler only once, so that repeated constructions do not duplicate log records
+        if _LOG_HANDLER not in logger.handlers:
+            logger.addHandler(_LOG_HANDLER)
+
+        # Keep a reference to the logger to avoid looking it up on every call
+        self.logger = logger
 
         # Keep the latest file upload timestamp for each user-chat combination
         self.user_timestamps = SharedUserFilesLatestUploadDict()
@@ -163,8 +258,8 @@ class Pipeline:
 
     async def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies form data before the OpenAI API request.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"INLET begin:\nBody: {json.dumps(body, indent=2)}")
+        self.logger.debug(f"INLET begin")
+        # self.logger.debug("INLET begin:\nBody: %s", json.dumps(body, indent=2))
 
         # Check if the body contains files
         if body.get("files", []):
@@ -175,43 +270,50 @@ class Pipeline:
             # Extract model creation timestamp from the request body
             model_timestamp = body.get('metadata', {}).get('model', {}).get('created', 0)
 
-            # Update the user-chat timestamp in the shared dictionary
-            self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, model_timestamp)
+            # Update the user-chat timestamp in the shared dictionary and retrieve the latest one
+            latest_timestamp = self.user_timestamps.update_and_get_user_latest_timestamp(user_id, chat_id, model_timestamp)
 
-            # Retrieve latest user-chat timestamp from the shared dictionary
-            latest_timestamp = self.user_timestamps.get_user_latest_timestamp(user_id, chat_id)
+            # Collect the new files and their latest timestamp, to update the shared dictionaries once
+            new_file_infos = []
+            new_latest_timestamp = latest_timestamp
 
-            for file_info in body["files"][::-1]:
+            for file_info in reversed(body["files"]):
                 # Extract file creation timestamp from the request body
                 file_timestamp = file_info.get('file', {}).get('updated_at', 0)
 
-                # If the file was uploaded after the latest timestamp, update the user files
+                # If the file was uploaded after the latest timestamp, collect it
                 if file_timestamp > latest_timestamp:
-                    # Create an OIFile instance and insert it into the shared dictionary
-                    self.user_files.add_user_file_info(
-                        user_id=user_id,
-                        chat_id=chat_id,
-                        file_info=file_info
-                    )
+                    new_file_infos.append(file_info)
 
-                    # Update the user-chat timestamp in the shared dictionary
-                    self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, file_timestamp)
+                    if file_timestamp > new_latest_timestamp:
+                        new_latest_timestamp = file_timestamp
 
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET end")
+            if new_file_infos:
+                # Insert the new files into the shared dictionary
+                self.user_files.add_user_file_infos(
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    file_infos=new_file_infos
+                )
+
+                # Update the user-chat timestamp in the shared dictionary
+                self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, new_latest_timestamp)
+
+        self.logger.debug(f"INLET end")
 
         return body
 
     async def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies OpenAI response form data before returning them to the user.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin:\nBody: {json.dumps(body, indent=2)}")
+        self.logger.debug(f"OUTLET begin")
+        # self.logger.debug("OUTLET begin:\nBody: %s", json.dumps(body, indent=2))
 
         user_id = __user__['id']
         chat_id = body.get('chat_id', '')
 
         self.user_files.clear_user_files_info(user_id, chat_id)
 
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET end")
+        self.logger.debug(f"OUTLET end")
 
         return body
 
@@ -219,9 +321,9 @@ class Pipeline:
         self, user_message: str, model_id: str, messages: list[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
         '''Custom pipeline logic (like RAG).'''
-        logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin: Body:\n{json.dumps(body, indent=2)}")
-        # logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin: Messages:\n{json.dumps(messages, indent=2)}")
+        self.logger.debug(f"PIPE begin")
+        # self.logger.debug("PIPE begin: Body:\n%s", json.dumps(body, indent=2))
+        # self.logger.debug("PIPE begin: Messages:\n%s", json.dumps(messages, indent=2))
 
         # Prepare return data
         return_data = ''
@@ -233,12 +335,19 @@ class Pipeline:
             # Define a list to store files to process
             files_infos_to_process = []
 
-            for msg in messages[::-1]:
-                # logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Message: {msg}")
+            # Find the latest user message, which carries the chat ID written by the filter function
+            msg = next((m for m in reversed(messages) if m.get("role") == "user"), None)
+
+            if msg is not None:
+                # self.logger.debug("PIPE: Message: %s", msg)
 
-                if msg["role"] == "user":
+                # Skip decoding content which cannot be the JSON object written by the filter function,
+                # avoiding a failed parse of plain (possibly long) user prompts
+                if not (isinstance(msg["content"], str) and msg["content"].startswith('{')):
+                    self.logger.warning("PIPE: Could not decode user message content as JSON: %s", msg['content'])
+                else:
                     try:
-                        msg_content_json = json.loads(msg["content"])
+                        msg_content_json = _json_loads(msg["content"])
 
                         if msg_content_json:
                             # Extract chat ID from the message content
@@ -246,34 +355,31 @@ class Pipeline:
 
                             files_infos_to_process = self.user_files.get_user_files_info(user_id, chat_id)
 
-                            # logging.getLogger(self.valves.APP_ID).debug(f"PIPE: User input files to process for user ID: {user_id} and chat ID: {chat_id}: {files_infos_to_process}")
+                            # self.logger.debug("PIPE: User input files to process for user ID: %s and chat ID: %s: %s", user_id, chat_id, files_infos_to_process)
                         else:
-                            logging.getLogger(self.valves.APP_ID).warning(f"PIPE: No user input files found for user ID: {user_id}")
-
-                        break
+                            self.logger.warning("PIPE: No user input files found for user ID: %s", user_id)
                     except json.JSONDecodeError:
-                        logging.getLogger(self.valves.APP_ID).warning(f"PIPE: Could not decode user message content as JSON: {msg['content']}")
-                        continue
+                        self.logger.warning("PIPE: Could not decode user message content as JSON: %s", msg['content'])
 
             if not files_infos_to_process:
                 return_data = "ERROR: No compatible files were uploaded. This model only supports uploading documents and raw text files."
-                logging.getLogger(self.valves.APP_ID).warning(f"PIPE: No input files were provided")
+                self.logger.warning(f"PIPE: No input files were provided")
             else:
-                if not any(user_file['file']['meta']['size'] for user_file in files_infos_to_process):
+                # Keep only the non-empty files, so that empty ones are not sent to the LangGraph service,
+                # tolerating files without size information
+                files_infos_to_process = [
+                    user_file for user_file in files_infos_to_process
+                    if user_file.get('file', {}).get('meta', {}).get('size', 0)
+                ]
+
+                if not files_infos_to_process:
                     return_data = "ERROR: All uploaded documents are empty."
-                    logging.getLogger(self.valves.APP_ID).warning(f"PIPE: All user-uploaded documents are empty")
+                    self.logger.warning(f"PIPE: All user-uploaded documents are empty")
                 else:
                     try:
-                        # logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Creating LangGraph thread for processing user-uploaded documents")
-
-                        # Create thread with unique ID
-                        thread = self.client.threads.create(thread_id=str(uuid.uuid4()))
-
-                        # logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Thread created with ID: {thread['thread_id']}")
-
-                        # Run agent with document
+                        # Run agent with document in a single request, without creating a thread first
                         res = self.client.runs.wait(
-                            thread['thread_id'],  # Threadless run
+                            None,  # Threadless run
                             "agent",  # Name of assistant (defined in langgraph.json)
                             input={
                                 "files": files_infos_to_process,
@@ -282,13 +388,14 @@ class Pipeline:
 
                         if res and 'result' in res:
                             result = res['result']
-                            return_data = json.dumps([{
+                            # Extract the summaries within the error handling, streaming only their serialization
+                            summaries = [{
                                 'id': f['id'],
                                 'filename': f['name'],
                                 'summary': f['summary']
                                 } for f in result.values() if f]
-                            , indent=2)
-                            # logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Result: {result}")
+                            return_data = self._stream_summaries(summaries)
+                            # self.logger.debug("PIPE: Result: %s", result)
                         elif res and "__error__" in res:
                             # Check if there's an error in the response
                             error_type = res["__error__"].get("error", "Unknown")
@@ -300,32 +407,54 @@ class Pipeline:
                             else:
                                 return_data = "ERROR: The document processing service encountered an error. Please try again later."
 
-                            logging.getLogger(self.valves.APP_ID).error(error_msg)
+                            self.logger.error(error_msg)
                         else:
                             return_data = "ERROR: Error processing the contents of uploaded documents."
-                            logging.getLogger(self.valves.APP_ID).error(f"PIPE: Missing 'result' in response: {res}")
+                            self.logger.error("PIPE: Missing 'result' in response: %s", res)
 
                     except KeyError as e:
-                        logging.getLogger(self.valves.APP_ID).error(f"PIPE: Missing key in response: {str(e)}")
+                        self.logger.error("PIPE: Missing key in response: %s", e)
                         return_data = "ERROR: Unexpected response format from document processing service."
 
                     except TimeoutError:
-                        logging.getLogger(self.valves.APP_ID).error("PIPE: Request timed out while processing document")
+                        self.logger.error("PIPE: Request timed out while processing document")
                         return_data = "ERROR: The request timed out while processing your document. Please try again later."
 
                     except httpx.ConnectError as e:
-                        logging.getLogger(self.valves.APP_ID).error(f"PIPE: Connection error to LangGraph service: {str(e)}")
+                        self.logger.error("PIPE: Connection error to LangGraph service: %s", e)
                         return "ERROR: Cannot connect to document processing service. Please check if the service is running."
 
                     except ConnectionError as e:
-                        logging.getLogger(self.valves.APP_ID).error(f"PIPE: Connection error when communicating with language processing service: {str(e)}")
+                        self.logger.error("PIPE: Connection error when communicating with language processing service: %s", e)
                         return_data = "ERROR: Unable to connect to document processing service. Please try again later."
 
                     except Exception as e:
-                        logging.getLogger(self.valves.APP_ID).error(f"PIPE: Unexpected error processing document: {str(e)}", exc_info=True)
+                        self.logger.error("PIPE: Unexpected error processing document: %s", e, exc_info=True)
                         return_data = "ERROR: An unexpected error occurred while processing your document."
 
-        logging.getLogger(self.valves.APP_ID).debug("PIPE end")
-        # logging.getLogger(self.valves.APP_ID).debug(f"PIPE end: Return data:\n{return_data}")
+        self.logger.debug("PIPE end")
+        # self.logger.debug("PIPE end: Return data:\n%s", return_data)
+
+        return return_data
+
+    def _stream_summaries(self, summaries: list[dict]) -> Generator:
+        '''
+        Stream the summaries of the user-uploaded files as a JSON array,
+        serializing the summary of one file at a time.
+
+        Input parameters:
+        * summaries: A list with the summary information of each file.
+
+        Yields:
+        * Parts of the JSON array with the summaries of the files.
+        '''
+        # Open the JSON array with the first summary
+        separator = "["
+
+        for summary in summaries:
+            # Serialize without indentation, as the result is parsed by the filter function
+            yield separator + _json_dumps(summary)
+            separator = ","
 
-        return return_data
\ No newline at end of file
+        # Close the JSON array (or yield an empty one, if no file was summarized)
+        yield "[]" if separator == "[" else "]"
\ No newline at end of file
@@ -1,8 +1,11 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, Field
 from pydantic_core import core_schema
 from requests.adapters import HTTPAdapter
 from typing import Any, Generator, Iterator, Optional, Union
 from urllib3.util.retry import Retry
+import hashlib
 import html
 import json
 import logging
@@ -13,6 +16,152 @@ import sys
 import threading
 
 
+try:
+    # Use the faster lxml library for extracting the text of HTML markup, if available
+    from lxml import etree as _lxml_etree
+    from lxml import html as _lxml_html
+except ImportError:
+    _lxml_html = None
+
+
+# Maximum number of summaries kept in the cache, keyed by a hash of the summarized text
+_SUMMARY_CACHE_SIZE = 256
+
+# Bounded LRU cache of normalized file contents, keyed by a hash of the raw content, so that the raw
+# documents are not kept alive by the cache, and skipping large contents to bound its memory usage
+_NORMALIZED_CONTENT_CACHE = OrderedDict()
+_NORMALIZED_CONTENT_CACHE_LOCK = threading.Lock()
+_NORMALIZED_CONTENT_CACHE_SIZE = 128
+_NORMALIZED_CONTENT_CACHE_MAX_CHARS = 1_000_000
+
+# Compiled patterns normalizing the content of user-uploaded files
+_HTML_COMMENT_PATTERN = re.compile(r'<!--.*?-->', flags=re.DOTALL)
+_HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+_BROKEN_ABBREVIATION_PATTERN = re.compile(r'([a-zA-Zα-ωΑ-Ω])\.\s+:')
+
+# Compiled pattern matching, in a single scan, spaces before punctuation,
+# runs of multiple spaces and runs of more than two consecutive newlines
+_SPACING_PATTERN = re.compile(r' +([.,:])| {2,}|\n{3,}')
+
+# Common HTML entities decoded with plain string replacements, with the ampersand
+# entity last, so that decoded ampersands are never decoded again as part of an entity
+_BASIC_HTML_ENTITIES = (
+    ('&lt;', '<'),
+    ('&gt;', '>'),
+    ('&quot;', '"'),
+    ('&#39;', "'"),
+    ('&nbsp;', '\xa0'),
+    ('&amp;', '&'),
+)
+
+
+def _fix_spacing(match: re.Match) -> str:
+    # Remove the spaces before punctuation, collapse multiple spaces into a single space,
+    # and keep no more than two consecutive newlines
+    punctuation = match.group(1)
+    if punctuation:
+        return punctuation
+    return ' ' if match.group()[0] == ' ' else '\n\n'
+
+
+def _unescape_html(text: str) -> str:
+    # Decode the HTML entities of the text with string replacements when every ampersand
+    # starts a common entity, falling back to the full decoder of the html module otherwise
+    if text.count('&') != sum(text.count(entity) for entity, _ in _BASIC_HTML_ENTITIES):
+        return html.unescape(text)
+
+    for entity, character in _BASIC_HTML_ENTITIES:
+        text = text.replace(entity, character)
+
+    return text
+
+
+def _extract_markup_text(text: str) -> Optional[str]:
+    # Extract the text of HTML markup with lxml, if available and if the text contains closing or self-closing tags,
+    # returning None when the text should be processed by the regular expression passes instead
+    if _lxml_html is None or '<' not in text or ('</' not in text and '/>' not in text):
+        return None
+
+    try:
+        # Lift the default size limits of libxml2, which otherwise silently truncate large documents
+        root = _lxml_html.fromstring(text, parser=_lxml_html.HTMLParser(huge_tree=True))
+    except (ValueError, _lxml_etree.LxmlError):
+        # Fall back to the regular expression passes for markup which lxml cannot parse
+        return None
+
+    # Fall back to the regular expression passes if the markup is a lone comment or processing instruction,
+    # whose text would otherwise be kept
+    return root.text_content() if isinstance(root, _lxml_html.HtmlElement) else None
+
+
+def _cached_normalize_content(text_content: str) -> str:
+    # Normalize the content of a user-uploaded file, caching the results of the most recent small contents
+    if len(text_content) > _NORMALIZED_CONTENT_CACHE_MAX_CHARS:
+        return _normalize_content(text_content)
+
+    cache_key = hashlib.blake2b(text_content.encode(), digest_size=16).digest()
+
+    with _NORMALIZED_CONTENT_CACHE_LOCK:
+        text = _NORMALIZED_CONTENT_CACHE.get(cache_key)
+        if text is not None:
+            _NORMALIZED_CONTENT_CACHE.move_to_end(cache_key)
+            return text
+
+    text = _normalize_content(text_content)
+
+    with _NORMALIZED_CONTENT_CACHE_LOCK:
+        # Cache the normalized content, evicting the least recently used entry if full
+        _NORMALIZED_CONTENT_CACHE[cache_key] = text
+        if len(_NORMALIZED_CONTENT_CACHE) > _NORMALIZED_CONTENT_CACHE_SIZE:
+            _NORMALIZED_CONTENT_CACHE.popitem(last=False)
+
+    return text
+
+
+def _normalize_content(text_content: str) -> str:
+    # Normalize the content of a user-uploaded file
+    text = ''
+
+    if text_content:
+        text = text_content
+
+        # Extract the text of HTML markup (without comments and tags, and with decoded entities) in a single pass
+        markup_text = _extract_markup_text(text)
+
+        if markup_text is not None:
+            text = markup_text
+        else:
+            # Skip the markup passes for plain text, which contains no tags or entities
+            if '<' in text:
+                # Step 1: Remove HTML comments
+                text = _HTML_COMMENT_PATTERN.sub('', text)
+
+                # Step 2: Remove HTML tags
+                text = _HTML_TAG_PATTERN.sub('', text)
+
+            if '&' in text:
+                # Step 3: Decode HTML entities like &nbsp;
+                text = _unescape_html(text)
+
+        # Step 4: Fix specific layout issues from the document
+        # Fix broken lines that should be together (like "Αριθμός Γ.Ε.ΜΗ .: 180526838000"),
+        # which is not affected by normalizing the lengths of the whitespace runs beforehand
+        text = _BROKEN_ABBREVIATION_PATTERN.sub(r'\1.:', text)
+
+        # Step 5: Fix spacing issues in a single pass
+        # Remove extra spaces before punctuation, normalize multiple spaces and
+        # normalize newlines (no more than two consecutive)
+        text = _SPACING_PATTERN.sub(_fix_spacing, text)
+
+        # Clean up trailing whitespace on each line
+        text = '\n'.join(line.rstrip() for line in text.splitlines())
+
+        # Clean up whitespaces at the beginning and ending of each string
+        text = text.strip()
+
+    return text
+
+
 class OIFile:
     '''
     This is a class for representing a user-uploaded document object.
@@ -25,7 +174,7 @@ class OIFile:
     - id (str): Unique identifier for the file.
     - name (str): Name of the file.
     - type (str): MIME type of the file.
-    - content (str): Normalized content of the file.
+    - content (str): Normalized content of the file, built on first access.
     - summary (str, optional): Summary of the file content.
     - timestamp (int, optional): Timestamp of when the file was uploaded.
     '''
@@ -33,7 +182,12 @@ class OIFile:
         self.id = id
         self.name = name
         self.type = type
-        self.content = self._build_content(content)
+        # Keep the raw content, deferring its normalization until the content is first accessed,
+        # so that files which are discarded (e.g. older uploads) are never normalized; the raw
+        # content is released once it is normalized, under a lock, as files are shared across threads
+        self._raw_content = content
+        self._content = None
+        self._content_lock = threading.Lock()
         self.summary = None
         self.timestamp = None
 
@@ -47,10 +201,20 @@ class OIFile:
         return self.type
 
     def get_content(self) -> str:
-        return self.content
+        # Read the normalized content without the lock once it is built
+        content = self._content
+        if content is None:
+            with self._content_lock:  # Acquire the lock for building the content
+                # Check again under the lock, as another thread may have built the content in the meantime
+                content = self._content
+                if content is None:
+                    # Normalize the raw content on first access, and release it afterwards
+                    self._content = content = self._build_content(self._raw_content)
+                    self._raw_content = None
+        return content
 
     def get_size(self) -> int:
-        return len(self.content)
+        return len(self.get_content())
 
     def get_summary(self) -> str:
         return self.summary or ''
@@ -65,47 +229,11 @@ class OIFile:
         self.timestamp = timestamp
 
     def _build_content(self, text_content: str) -> str:
-        text = ''
-
-        if text_content:
-            text = text_content
-
-            # Step 1: Remove HTML comments
-            text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
-
-            # Step 2: Remove HTML comments (duplicate step in original code)
-            text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
-
-            # Step 3: Remove HTML tags
-            text = re.sub(r'<[^>]+>', '', text)
-
-            # Step 4: Decode HTML entities like &nbsp;
-            text = html.unescape(text)
-
-            # Step 5: Fix spacing issues
-            # Normalize multiple spaces
-            text = re.sub(r' +', ' ', text)
-
-            # Normalize newlines (no more than two consecutive)
-            text = re.sub(r'\n{3,}', '\n\n', text)
-
-            # Step 6: Fix specific layout issues from the document
-            # Fix broken lines that should be together (like "Αριθμός Γ.Ε.ΜΗ .: 180526838000")
-            text = re.sub(r'([a-zA-Zα-ωΑ-Ω])\.\s+:', r'\1.:', text)
-
-            # Step 7: Remove extra spaces before punctuation
-            text = re.sub(r' ([.,:])', r'\1', text)
-
-            # Clean up trailing whitespace on each line
-            text = '\n'.join(line.rstrip() for line in text.splitlines())
-
-            # Clean up whitespaces at the beginning and ending of each string
-            text.strip()
-
-        return text
+        # Normalize through the cached module-level function, so that re-materialized files are not normalized again
+        return _cached_normalize_content(text_content) if text_content else ''
 
     def __repr__(self) -> str:
-        return f"File(id={self.id}, name={self.name}, type={self.type}, size={len(self.content)} bytes)"
+        return f"File(id={self.id}, name={self.name}, type={self.type}, size={self.get_size()} bytes)"
 
     @classmethod
     def __get_pydantic_core_schema__(
@@ -135,7 +263,7 @@ class OIFile:
             "id": self.id,
             "name": self.name,
             "type": self.type,
-            "content": self.content,
+            "content": self.get_content(),
             "summary": self.summary
         }
 
@@ -144,49 +272,46 @@ class SharedUserFilesDict:
     '''
     This is a class for creating a shared dictionary for
     storing the latest uploaded files for each user-chat
-    combination. It uses a lock to ensure thread safety
-    when accessing the shared dictionary.
+    combination. Each entry is an immutable tuple, which
+    writers replace under a lock (copy-on-write), so that
+    readers can retrieve it without locking.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._lock = threading.Lock()  # Create a lock for writers
 
     def add_user_file_info(self, user_id: str, chat_id: str, file_info: OIFile) -> None:
-        # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        # Construct index key combining user_id and chat_id into a tuple
+        key = (user_id, chat_id)
 
         with self._lock:  # Acquire the lock for inserting data
-            # Update file name
-            self._data.setdefault(key, []).append(file_info)
+            # Publish a new tuple with the file appended, leaving the previous one intact for readers
+            self._data[key] = self._data.get(key, ()) + (file_info,)
 
     def add_user_file_infos(self, user_id: str, chat_id: str, file_infos: list[OIFile]) -> None:
-        # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        # Construct index key combining user_id and chat_id into a tuple
+        key = (user_id, chat_id)
 
         with self._lock:  # Acquire the lock for inserting data
-            # Update file name
-            self._data.setdefault(key, []).extend(file_infos)
-
-    def get_user_files_info(self, user_id: str, chat_id: str) -> list[OIFile]:
-        return_data = None
+            # Publish a new tuple with the files appended, leaving the previous one intact for readers
+            self._data[key] = self._data.get(key, ()) + tuple(file_infos)
 
-        # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+    def get_user_files_info(self, user_id: str, chat_id: str) -> tuple[OIFile, ...]:
+        # Construct index key combining user_id and chat_id into a tuple
+        key = (user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for retrieving data
-            # If key exists in the dictionary, return its value, otherwise return 0
-            return_data = self._data.get(key, [])
-
-        return return_data
+        # A single dictionary lookup is atomic under the GIL and entries are never modified in place,
+        # hence no lock is required for reading
+        # If key exists in the dictionary, return its value, otherwise return an empty tuple
+        return self._data.get(key, ())
 
     def clear_user_files_info(self, user_id: str, chat_id: str) -> None:
-        # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        # Construct index key combining user_id and chat_id into a tuple
+        key = (user_id, chat_id)
 
         with self._lock:  # Acquire the lock for clearing data
             # Clear user files info
-            if key in self._data:
-                del self._data[key]
+            self._data.pop(key, None)
 
 
 class SharedUserFilesLatestUploadDict:
@@ -194,29 +319,32 @@ class SharedUserFilesLatestUploadDict:
     This is a class for creating a shared dictionary
     for storing the latest file upload timestamp for
     each user-chat combination. It uses a lock to ensure
-    thread safety when accessing the shared dictionary.
+    thread safety when updating the shared dictionary, while
+    reads are lock-free.
     '''
     def __init__(self):
         self._data = dict()
-        self._lock = threading.Lock()  # Create a lock
+        self._lock = threading.Lock()  # Create a lock for writers
 
     def get_user_latest_timestamp(self, user_id: str, chat_id: str) -> int:
-        # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        # Construct index key combining user_id and chat_id into a tuple
+        key = (user_id, chat_id)
 
-        with self._lock:  # Acquire the lock for retrieving data
-            # If key exists in the dictionary, return its value, otherwise return 0
-            return_data = self._data.get(key, 0)
-
-        return return_data
+        # A single dictionary lookup is atomic under the GIL, hence no lock is required for reading
+        # If key exists in the dictionary, return its value, otherwise return 0
+        return self._data.get(key, 0)
 
     def update_user_latest_timestamp(self, user_id: str, chat_id: str, timestamp: int) -> None:
-        # Construct index key combining user_id and chat_id
-        key = f'{user_id}_{chat_id}'
+        # Construct index key combining user_id and chat_id into a tuple
+        key = (user_id, chat_id)
+
+        # Skip the lock if the stored timestamp is already newer, as timestamps only increase
+        if timestamp <= self._data.get(key, 0):
+            return
 
         with self._lock:  # Acquire the lock for inserting data
-            # If key exists in the dictionary, compare update its value to the timestamp
-            if timestamp > self._data.setdefault(key, 0):
+            # Compare again under the lock, as another writer may have stored a newer timestamp meanwhile
+            if timestamp > self._data.get(key, 0):
                 # Update latest timestamp
                 self._data[key] = timestamp
 
@@ -274,6 +402,9 @@ class Pipeline:
         handlersys.setFormatter(formatter)
         logger.addHandler(handlersys)
 
+        # Keep a reference to the logger to avoid looking it up on every call
+        self.logger = logger
+
         # Initialize user file contents dictionary
         self.user_files = SharedUserFilesDict()
 
@@ -293,6 +424,17 @@ class Pipeline:
             "Content-Type": "application/json",
         }
 
+        # Initialize HTTP sessions reused across requests, keeping connections to the LLM service alive
+        self.session = self._create_session(max_retries=5, wait_interval=10)
+        self.status_session = self._create_session()
+
+        # Initialize a pool of workers for sending the requests of multiple files to the LLM service concurrently
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="summarization")
+
+        # Initialize a bounded LRU cache of summaries, so that re-uploaded content skips the LLM call
+        self._summary_cache = OrderedDict()
+        self._summary_cache_lock = threading.Lock()
+
         self.system_prompt = '''
             You are a document and literature analysis assistant specialized in identifying important information in text documents.
             Your response should be consise and focused on the most relevant information, and should not include any personal opinions or interpretations.
@@ -318,7 +460,12 @@ class Pipeline:
 
     async def on_shutdown(self):
         '''This function is called when the server is stopped.'''
-        pass
+        # Stop the workers, without waiting for pending requests
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        # Close the HTTP sessions and their pooled connections
+        self.session.close()
+        self.status_session.close()
 
     async def on_valves_updated(self):
         '''This function is called when the valves are updated.'''
@@ -326,8 +473,8 @@ class Pipeline:
 
     async def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies form data before the OpenAI API request.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"INLET begin:\nBody: {json.dumps(body, indent=2)}")
+        self.logger.debug(f"INLET begin")
+        # self.logger.debug(f"INLET begin:\nBody: {json.dumps(body, indent=2)}")
 
         # Check if the body contains files
         if body.get("files", []):
@@ -360,29 +507,29 @@ class Pipeline:
                     # Update the user-chat timestamp in the shared dictionary
                     self.user_timestamps.update_user_latest_timestamp(user_id, chat_id, file_timestamp)
 
-        logging.getLogger(self.valves.APP_ID).debug(f"INLET end")
+        self.logger.debug(f"INLET end")
 
         return body
 
     async def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         '''Modifies OpenAI response form data before returning them to the user.'''
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"OUTLET begin:\nBody: {json.dumps(body, indent=2)}")
+        self.logger.debug(f"OUTLET begin")
+        # self.logger.debug(f"OUTLET begin:\nBody: {json.dumps(body, indent=2)}")
 
         user_id = __user__['id']
         chat_id = body.get('chat_id', '')
 
         self.user_files.clear_user_files_info(user_id, chat_id)
 
-        logging.getLogger(self.valves.APP_ID).debug(f"OUTLET end")
+        self.logger.debug(f"OUTLET end")
 
         return body
 
     def pipe(self, user_message: str, model_id: str, messages: list[dict], body: dict) -> Union[str, Generator, Iterator]:
         '''Custom pipeline logic (like RAG).'''
-        logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin")
-        # logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin: Body:\n{json.dumps(body, indent=2)}")
-        # logging.getLogger(self.valves.APP_ID).debug(f"PIPE begin: Messages:\n{json.dumps(messages, indent=2)}")
+        self.logger.debug(f"PIPE begin")
+        # self.logger.debug(f"PIPE begin: Body:\n{json.dumps(body, indent=2)}")
+        # self.logger.debug(f"PIPE begin: Messages:\n{json.dumps(messages, indent=2)}")
 
         # Prepare return data
         return_data = ''
@@ -395,7 +542,7 @@ class Pipeline:
             files_infos_to_process = []
 
             for msg in messages[::-1]:
-                # logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Message: {msg}")
+                # self.logger.debug(f"PIPE: Message: {msg}")
 
                 if msg["role"] == "user":
                     try:
@@ -407,47 +554,52 @@ class Pipeline:
 
                             files_infos_to_process = self.user_files.get_user_files_info(user_id, chat_id)
 
-                            # logging.getLogger(self.valves.APP_ID).debug(f"PIPE: User input files to process for user ID: {user_id} and chat ID: {chat_id}: {files_infos_to_process}")
+                            # self.logger.debug(f"PIPE: User input files to process for user ID: {user_id} and chat ID: {chat_id}: {files_infos_to_process}")
                         else:
-                            logging.getLogger(self.valves.APP_ID).warning(f"PIPE: No user input files found for user ID: {user_id}")
+                            self.logger.warning(f"PIPE: No user input files found for user ID: {user_id}")
 
                         break
                     except json.JSONDecodeError:
-                        logging.getLogger(self.valves.APP_ID).warning(f"PIPE: Could not decode user message content as JSON: {msg['content']}")
+                        self.logger.warning(f"PIPE: Could not decode user message content as JSON: {msg['content']}")
                         continue
 
             if not files_infos_to_process:
                 return_data = "ERROR: No compatible files were uploaded. This model only supports uploading documents and raw text files."
-                logging.getLogger(self.valves.APP_ID).warning(f"PIPE: No input files were provided")
+                self.logger.warning(f"PIPE: No input files were provided")
             else:
                 if not any(file.get_size() for file in files_infos_to_process):
                     return_data = "ERROR: All uploaded documents are empty."
-                    logging.getLogger(self.valves.APP_ID).warning(f"PIPE: All user-uploaded documents are empty")
+                    self.logger.warning(f"PIPE: All user-uploaded documents are empty")
                 else:
-                    logging.getLogger(self.valves.APP_ID).debug(f"PIPE: User input files to process:\n{files_infos_to_process}")
+                    self.logger.debug("PIPE: User input files to process:\n%s", files_infos_to_process)
 
                     data = []
 
+                    futures = []
+
                     for file in files_infos_to_process:
-                        try:
-                            logging.getLogger(self.valves.APP_ID).debug(f"PIPE: Getting file summary using the LLM model...")
+                        self.logger.debug(f"PIPE: Getting file summary using the LLM model...")
 
-                            summary = self._get_summary(file.get_content())
+                        # Send the request of the file to the LLM service in the background
+                        futures.append((file, self.executor.submit(self._get_summary, file.get_content())))
 
+                    # Collect the summaries in the order of the files, while the remaining requests are in flight
+                    for file, future in futures:
+                        try:
                             data.append({
                                 "id": file.get_id(),
                                 "filename": file.get_name(),
-                                "summary": summary,
+                                "summary": future.result(),
                             })
                         except Exception as e:
-                            logging.getLogger(self.valves.APP_ID).error(f"PIPE: Error processing file {file.get_name()}: {e}")
+                            self.logger.error(f"PIPE: Error processing file {file.get_name()}: {e}")
 
                     if data:
                         return_data = json.dumps(data, indent=2)
                     else:
                         return_data = "Error processing the content of uploaded DOCX files."
 
-        logging.getLogger(self.valves.APP_ID).debug(f"PIPE end")
+        self.logger.debug(f"PIPE end")
 
         return return_data
 
@@ -490,7 +642,7 @@ class Pipeline:
         return files
 
     # Change from async function to regular function
-    def _get_summary(self, text: str, max_retries: int=5, wait_interval: int=10) -> str:
+    def _get_summary(self, text: str) -> str:
         '''
         This function sends a request to the OpenAI API to get a summarization of the provided text.
         If the text is empty, it returns a message indicating that no content was provided.
@@ -509,11 +661,26 @@ class Pipeline:
         else:
             # Check API key before making request
             if not self.valves.LITELLM_API_KEY:
-                logging.getLogger(self.valves.APP_ID).error(f"_get_summary: Invalid API key configuration")
+                self.logger.error(f"_get_summary: Invalid API key configuration")
                 summary = "Error: API key not properly configured. Please set a valid LITELLM_API_KEY environment variable."
             else:
+                # Key the cache by the model, the prompts and a hash of the text, as the summary depends on all of them
+                cache_key = hashlib.blake2b(
+                    f"{self.valves.MODEL_ID}\0{self.system_prompt}\0{self.user_prompt_template}\0{text}".encode(),
+                    digest_size=16,
+                ).digest()
+
+                with self._summary_cache_lock:
+                    cached_summary = self._summary_cache.get(cache_key)
+                    if cached_summary is not None:
+                        self._summary_cache.move_to_end(cache_key)
+
+                if cached_summary is not None:
+                    self.logger.debug(f"_get_summary: Returning cached summary")
+                    return cached_summary
+
                 if self._check_litellm_status():
-                    logging.getLogger(self.valves.APP_ID).debug(f"_get_summary: LiteLLM service is running")
+                    self.logger.debug(f"_get_summary: LiteLLM service is running")
 
                     # Create LLM summarization payload
                     summarization_payload = {
@@ -528,30 +695,18 @@ class Pipeline:
 
                     url = f"{self.service_url.rstrip('/').rstrip('/v1')}/v1/chat/completions"
 
-                    # Log request info (without sensitive data)
-                    masked_headers = dict(self.http_headers)
-                    if "Authorization" in masked_headers:
-                        masked_headers["Authorization"] = "Bearer sk-****"
-                    logging.getLogger(self.valves.APP_ID).debug(
-                        f"_get_summary: Sending request to {url} with masked headers {masked_headers}"
-                    )
-
-                    try:
-                        # Create a session with proper retry handling
-                        session = requests.Session()
-                        session.trust_env = False  # Ignore environment variables
-                        retries = Retry(
-                            total=max_retries,
-                            backoff_factor=wait_interval,
-                            status_forcelist=[429, 500, 502, 503, 504],
-                            allowed_methods=frozenset(['POST'])  # Add POST method
+                    # Log request info (without sensitive data), only building the masked headers if logged
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        masked_headers = dict(self.http_headers)
+                        if "Authorization" in masked_headers:
+                            masked_headers["Authorization"] = "Bearer sk-****"
+                        self.logger.debug(
+                            "_get_summary: Sending request to %s with masked headers %s", url, masked_headers
                         )
-                        adapter = HTTPAdapter(max_retries=retries)
-                        session.mount('http://', adapter)
-                        session.mount('https://', adapter)
 
-                        # Try primary service
-                        response = session.post(
+                    try:
+                        # Try primary service, reusing the session with proper retry handling
+                        response = self.session.post(
                             url=url,
                             headers=self.http_headers,
                             json=summarization_payload,
@@ -563,22 +718,28 @@ class Pipeline:
                         if response.status_code == 200:
                             res = response.json()
                             summary = res["choices"][0]["message"]["content"]
+
+                            # Cache the successfully generated summary, evicting the least recently used entry if full
+                            with self._summary_cache_lock:
+                                self._summary_cache[cache_key] = summary
+                                if len(self._summary_cache) > _SUMMARY_CACHE_SIZE:
+                                    self._summary_cache.popitem(last=False)
                         elif response.status_code == 401:
-                            logging.getLogger(self.valves.APP_ID).error(f"_get_summary: Authentication error: {response.text}")
+                            self.logger.error(f"_get_summary: Authentication error: {response.text}")
                             summary = "Error: Authentication failed with the LLM service. Please check your API key."
                         else:
-                            logging.getLogger(self.valves.APP_ID).error(
+                            self.logger.error(
                                 f"_get_summary: HTTP Error {response.status_code}: {response.text}"
                             )
                             summary = f"_get_summary: Error: Service returned status code {response.status_code}"
                     except requests.exceptions.ConnectionError as e:
                         # Connection failed - log the issue
-                        logging.getLogger(self.valves.APP_ID).error(
+                        self.logger.error(
                             f"Failed to connect to LiteLLM at {self.service_url}: {e}"
                         )
                         summary = "Error: Could not connect to LLM service. Please try again later."
                     except Exception as e:
-                        logging.getLogger(self.valves.APP_ID).error(f"_get_summary: Error processing text: {e}")
+                        self.logger.error(f"_get_summary: Error processing text: {e}")
                         summary = f"Error processing text"
 
         return summary
@@ -588,19 +749,45 @@ class Pipeline:
         url = f"{self.service_url.rstrip('/').rstrip('/v1')}/health"
 
         try:
-            # Disable any proxy settings that might interfere
-            local_session = requests.Session()
-            local_session.trust_env = False  # Ignore environment variables
-
-            response = local_session.get(
+            # Reuse the session for status checks, which ignores any proxy settings that might interfere
+            response = self.status_session.get(
                 url=url,
                 headers=self.http_headers,
                 timeout=20,
                 proxies={"http": "", "https": ""}  # Explicitly bypass proxies
             )
-            logging.getLogger(self.valves.APP_ID).debug(f"_check_litellm_status: LiteLLM status check: {response.status_code}")
+            self.logger.debug("_check_litellm_status: LiteLLM status check: %s", response.status_code)
             return response.status_code == 200
         except requests.exceptions.ConnectionError as e:
-            logging.getLogger(self.valves.APP_ID).error(f"_check_litellm_status: Failed to connect to LiteLLM at {url}: {e}")
-            logging.getLogger(self.valves.APP_ID).error(f"_check_litellm_status: LiteLLM service is not running or unreachable.")
-            return False
\ No newline at end of file
+            self.logger.error(f"_check_litellm_status: Failed to connect to LiteLLM at {url}: {e}")
+            self.logger.error(f"_check_litellm_status: LiteLLM service is not running or unreachable.")
+            return False
+
+    def _create_session(self, max_retries: int=0, wait_interval: int=0) -> requests.Session:
+        '''
+        This function creates an HTTP session for the requests to the LiteLLM service.
+
+        The session ignores environment variables (such as proxy settings) and keeps a pool of
+        connections alive, so that consecutive requests do not repeat the TCP and TLS handshakes.
+        If retries are requested, failed POST requests are retried with an exponential backoff.
+
+        Input parameters:
+        * max_retries: The maximum number of retries of a failed request.
+        * wait_interval: The backoff factor (in seconds) between retries.
+
+        Returns:
+        * The HTTP session.
+        '''
+        session = requests.Session()
+        session.trust_env = False  # Ignore environment variables
+        retries = Retry(
+            total=max_retries,
+            backoff_factor=wait_interval,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['POST'])  # Add POST method
+        )
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=16)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
\ No newline at end of file
@@ -0,0 +1,42 @@
+from pathlib import Path
+import importlib.util
+import pytest
+
+
+def load_summarization_pipeline():
+    """
+    Load the summarization pipeline module from its file, as its name is not a valid module name.
+
+    Returns:
+        The loaded summarization pipeline module
+    """
+    path = Path(__file__).resolve().parent.parent / 'Pipelines' / 'summarization-pipeline.py'
+    spec = importlib.util.spec_from_file_location('summarization_pipeline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def test_lxml_markup_text_matches_regular_expressions():
+    """
+    Check that the lxml path extracts the same text as the regular expression passes for simple markup.
+    """
+    pytest.importorskip('lxml.html')
+    module = load_summarization_pipeline()
+
+    text = '<!-- comment --><p>Hello &amp; <b>world</b> .</p>\n\n\n\n<p>x  y &lt;z&gt;</p>'
+    assert module._extract_markup_text(text) is not None
+    assert module._normalize_content(text) == 'Hello & world.\n\nx y <z>'
+
+def test_lxml_markup_text_keeps_large_documents():
+    """
+    Check that the lxml path does not truncate documents beyond the default libxml2 size limits.
+    """
+    pytest.importorskip('lxml.html')
+    module = load_summarization_pipeline()
+
+    single_text = '<p>' + 'a' * 12_000_000 + '</p>'
+    assert len(module._normalize_content(single_text)) == 12_000_000
+
+    paragraphs_text = ''.join('<p>' + 'b' * 1_000_000 + '</p>' for _ in range(12))
+    assert len(module._normalize_content(paragraphs_text)) == 12_000_000
\ No newline at end of file